@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# import time benchmark
+# imports each module in a fresh interpreter with -X importtime and fails
+# if any of them goes over its budget (milliseconds, cumulative)
+# usage: python bench_imports.py [--repeat N]
+
+import subprocess
+import sys
+import os
+import argparse
+
+budgets = {'slurmpy': 50, 'mrpyconvert': 80, 'dicom2bids': 50,
+	'niftiviewer': 250}
+
+
+# cumulative import time of module in ms, best of repeat runs
+def ImportTime(module, repeat=3):
+	here = os.path.dirname(os.path.abspath(__file__))
+	env = dict(os.environ, PYTHONPATH=here)
+	best = None
+	for i in range(repeat):
+		proc = subprocess.run([sys.executable, '-X', 'importtime', '-c',
+			'import {}'.format(module)], env=env, capture_output=True, text=True)
+		if proc.returncode:
+			raise RuntimeError('import {} failed:\n{}'.format(module, proc.stderr))
+		for line in proc.stderr.splitlines():
+			fields = [x.strip() for x in line.split('|')]
+			if len(fields) == 3 and fields[2] == module:
+				us = int(fields[1])
+		best = us if best is None else min(best, us)
+	return best / 1000
+
+
+if __name__ == '__main__':
+	parser = argparse.ArgumentParser(description='check module import times')
+	parser.add_argument('--repeat', type=int, default=3)
+	args = parser.parse_args()
+
+	failed = []
+	for module, budget in budgets.items():
+		ms = ImportTime(module, args.repeat)
+		status = 'ok' if ms <= budget else 'OVER'
+		print('{:<12} {:8.1f} ms  (budget {} ms)  {}'.format(module, ms, budget, status))
+		if ms > budget:
+			failed.append(module)
+
+	sys.exit(1 if failed else 0)
@@ -8,8 +8,13 @@ import shutil
 import pwd
 import getpass
 import csv
+import hashlib
+import socket
+import time
+import contextlib
 
-import pydicom
+# pydicom is imported where it is used, it is slow to import and slurm
+# jobs that only need the script helpers shouldn't pay for it
 
 ## todo: pathlib
 
@@ -31,15 +36,174 @@ suffixes['func'] = ['bold', 'cbv', 'phase', 'sbref', 'events', 'physio', 'stim']
 subject_pattern = re.compile('(.*)_([0-9]{8})(.*)')    
 series_pattern = re.compile('.*Series_([0-9]*)_(.*)')
 
+# stage timing: records are written as JSON lines to timing_log (a path,
+# or '-' for stderr). Off unless set here or in $MRPYCONVERT_TIMING, which
+# slurm jobs inherit.
+timing_log = os.environ.get('MRPYCONVERT_TIMING')
+
+def LogRecord(record):
+	if not timing_log:
+		return
+	line = json.dumps(record, default = str) + '\n'
+	if timing_log == '-':
+		import sys
+		sys.stderr.write(line)
+	else:
+		with open(timing_log, 'a') as f:
+			f.write(line)
+
+@contextlib.contextmanager
+def Timed(stage, **fields):
+	"""time a stage and log it as one JSON record
+
+	The record is yielded so counters and sub-stage times (see 
+	Accumulate) can be added to it before it is written.
+
+	>>> with Timed('SortDicoms', input_dir = d) as record:
+	...     record['files'] = 10
+	"""
+	record = {'stage': stage, 'start': time.time()}
+	record.update(fields)
+	clock = time.perf_counter()
+	try:
+		yield record
+	finally:
+		record['seconds'] = round(time.perf_counter() - clock, 6)
+		LogRecord(record)
+
+@contextlib.contextmanager
+def Accumulate(record, key):
+	"""add the time spent inside the block to record[key]"""
+	clock = time.perf_counter()
+	try:
+		yield
+	finally:
+		record[key] = round(record.get(key, 0) + time.perf_counter() - clock, 6)
+
+# yields from iterable, adding the time spent waiting on it to record[key]
+def TimedIter(iterable, record, key):
+	iterator = iter(iterable)
+	while True:
+		with Accumulate(record, key):
+			try:
+				item = next(iterator)
+			except StopIteration:
+				return
+		yield item
+
+@contextlib.contextmanager
+def Profile(outfile = None, tool = 'cProfile'):
+	"""profile a block with cProfile or pyinstrument
+
+	outfile: where to save the cProfile stats or the pyinstrument text 
+	report. Prints the top of the report if not given.
+	"""
+	if tool == 'pyinstrument':
+		import pyinstrument
+		profiler = pyinstrument.Profiler()
+		profiler.start()
+		try:
+			yield profiler
+		finally:
+			profiler.stop()
+			if outfile:
+				with open(outfile, 'w') as f:
+					f.write(profiler.output_text())
+			else:
+				print(profiler.output_text())
+	else:
+		import cProfile, pstats
+		profiler = cProfile.Profile()
+		profiler.enable()
+		try:
+			yield profiler
+		finally:
+			profiler.disable()
+			if outfile:
+				profiler.dump_stats(outfile)
+			else:
+				pstats.Stats(profiler).sort_stats('cumulative').print_stats(30)
+
 
 def GetSeriesNames(directory):
-	return set([re.match(series_pattern, x[0]).group(2) for x in os.walk(directory) if 'Series' in x[0]])
+	catalog = ScanDicomDir(directory)
+	return set([re.match(series_pattern, series).group(2) for subject in catalog for series in catalog[subject]])
+
+# scans of dicom trees, dicomdir -> directory -> (mtime, its subdirectory
+# names, or for a series directory its catalog entry)
+scan_cache = dict()
+
+def ScanDicomDir(dicomdir):
+	"""catalog of a sorted dicom tree in one os.scandir pass
+
+	Returns
+	-------
+	dict of subject directory -> dict of series directory name -> 
+	{'ndicoms': number of files, 'nbytes': total size}
+
+	Each directory's listing is cached and reused until its mtime changes
+	(a file or directory added, removed or renamed in it), so a rescan 
+	only lists the directories that changed.
+	"""
+	dicomdir = os.path.normpath(dicomdir)
+	old = scan_cache.get(dicomdir, dict())
+	dirs = dict()
+	catalog = dict()
+
+	# stat before reading, a change meanwhile shows up next time
+	def cached(directory, read):
+		try:
+			mtime = os.stat(directory).st_mtime
+			if directory not in old or old[directory][0] != mtime:
+				old[directory] = (mtime, read(directory))
+		except OSError:
+			return None
+		dirs[directory] = old[directory]
+		return dirs[directory][1]
+
+	def subdirectories(directory):
+		return sorted(entry.name for entry in os.scandir(directory) if entry.is_dir())
+
+	def series_entry(seriesdir):
+		files = [f for f in os.scandir(seriesdir) if f.is_file()]
+		return {'ndicoms': len(files), 'nbytes': sum(f.stat().st_size for f in files)}
+
+	def scan(directory):
+		names = cached(directory, subdirectories)
+		if names is None:
+			return
+		if subject_pattern.match(os.path.basename(directory)):
+			subject = dict()
+			for name in names:
+				if series_pattern.match(name):
+					entry = cached(os.path.join(directory, name), series_entry)
+					if entry is not None:
+						subject[name] = entry
+			catalog[directory] = subject
+			return
+		for name in names:
+			scan(os.path.join(directory, name))
+
+	scan(dicomdir)
+	# drops directories that are gone
+	scan_cache[dicomdir] = dirs
+	return catalog
 
 def GetSubjectName(directory):
 	name = re.search(subject_pattern, os.path.basename(directory.strip('/'))).group(1)
 	return re.sub('[^0-9a-zA-Z]+', '', name)
 
+# BIDS labels are alphanumeric
+label_pattern = re.compile('^[0-9a-zA-Z]+$')
+
 class entity_chain:
+	"""one bids_dict entry, compiled once into a filename template
+
+	Entities are validated (known entity, alphanumeric label, unless 
+	nonstandard) and put in BIDS order here, and the chain isn't changed afterwards, so rendering 
+	names for any number of series shares nothing mutable. run always 
+	comes from the series number, see Render.
+	"""
 	def __init__(self, datatype, suffix, nonstandard = False, **kwargs):
 		
 		if not nonstandard:
@@ -56,46 +220,81 @@ class entity_chain:
 
 		## lets folks explicitly write entities = {'arg':'value'}
 		## and/or arg = 'value', usual **kwargs way
-		self.chain = kwargs
-		if 'entities' in kwargs:
-			del(self.chain['entities'])
-			self.chain.update(kwargs['entities'])
-		
-
-		if not self.chain:
-			self.chain = dict()
-
-		self.chain['run'] = '{}'
-
-
-
+		chain = dict(kwargs)
+		if 'entities' in chain:
+			del(chain['entities'])
+			chain.update(kwargs['entities'])
+		chain.pop('run', None)
+
+		for key, value in chain.items():
+			if key not in entities and not nonstandard:
+				raise ValueError('Unknown entity {}, allowed entities are {}'.format(key, entities))
+			if not label_pattern.match(str(value)) and not nonstandard:
+				raise ValueError('Entity {} label {} is not alphanumeric'.format(key, value))
+
+		# known entities in BIDS order, then any nonstandard ones as given
+		order = [k for k in entities if k in chain or k == 'run'] + [k for k in chain if k not in entities]
+		self.chain = {k: str(chain[k]) for k in order if k != 'run'}
+
+		# sub-{0}_..._run-{1}_..._suffix, braces in labels (allowed if 
+		# nonstandard) doubled so format leaves them as they are
+		escape = lambda x: str(x).replace('{', '{{').replace('}', '}}')
+		self.template = '_'.join(['sub-{0}'] + ['run-{1}' if k == 'run' else 
+			'{}-{}'.format(escape(k), escape(self.chain[k])) for k in order] + [escape(suffix)])
+		if 'ses' in self.chain:
+			self.directory = os.path.join('sub-{0}', 'ses-{}'.format(escape(self.chain['ses'])), escape(datatype))
+		else:
+			self.directory = os.path.join('sub-{0}', escape(datatype))
 
 	def __repr__(self):
 		return_string = 'datatype: {}, suffix: {}, entities: {}'.format(self.datatype, self.suffix, self.chain)
 		return return_string
 
+	def Render(self, subject, run):
+		"""(directory relative to bidsdir, filename) for one series of subject"""
+		return (self.directory.format(subject), 
+			self.template.format(subject, '{:02d}'.format(int(run))))
 
 	def GetFormatString(self):
-		format_string =  'sub-{}_'
-		if self.chain:
-			for key, value in [(k, self.chain[k]) for k in entities if k in self.chain]:
-				format_string += '{}-{}_'.format(key, value)
-
-		format_string += '{}'.format(self.suffix)
-
-		return format_string
+		# sub-{}_..._run-{}_..._suffix, for subject and run, braces in 
+		# labels stay doubled
+		return re.sub(r'\{\{|\}\}|\{[01]\}', lambda m: m.group(0) if len(m.group(0)) == 2 else '{}', 
+			self.template)
 
 	def __str__(self):
 		return self.GetFormatString()
 
 
 
+# glob pattern to regex, each * or ? is a capture group
+def GlobToRegex(pattern):
+	return ''.join('(.*?)' if p == '*' else '(.)' if p == '?' else re.escape(p) 
+		for p in re.split(r'(\*|\?)', pattern) if p)
+
 # explains how to map from series names to bids entries
 class bids_dict:
 	def __init__(self):
 		self.dictionary = dict()
+		self.rules = list()
+		# all rules in one regex, compiled on the first Lookup after an add
+		self.matcher = None
+		# series name -> entity_chain (or None) found by the rules
+		self.matched = dict()
 
-	def add(self, series_descripton, datatype, suffix, nonstandard = False, **kwargs):
+	def add(self, series_descripton, datatype, suffix, nonstandard = False, match = 'exact', **kwargs):
+		"""map series named series_descripton to datatype/suffix with entities
+
+		match: 'exact' (default), or 'regex' or 'glob' for a rule matching 
+		whole series names. Named regex groups that are BIDS entities set 
+		that entity, and entity values can use the captures as format 
+		fields: {1}, {2}... (each * and ? in a glob is a group) or {name}.
+		Captured labels are stripped to alphanumerics.
+
+		Exact names win over rules, and rules are tried in the order added.
+
+		>>> bd.add('fMRI_(?P<task>[a-z]+)[0-9]*_(?P<acq>.*)', 'func', 'bold', match = 'regex')
+		>>> bd.add('DTI_*dir', 'dwi', 'dwi', match = 'glob', dir = '{1}')
+		"""
 
 		# seems awkward
 		chain = dict(kwargs)
@@ -103,19 +302,109 @@ class bids_dict:
 			del(chain['entities'])
 			chain.update(kwargs['entities'])
 
-		self.dictionary[series_descripton] = entity_chain(datatype = datatype, suffix = suffix, 
-			nonstandard = nonstandard, **chain)
+		if match == 'exact':
+			self.dictionary[series_descripton] = entity_chain(datatype = datatype, suffix = suffix, 
+				nonstandard = nonstandard, **chain)
+
+		elif match in ['regex', 'glob']:
+			regex = re.compile(series_descripton if match == 'regex' else GlobToRegex(series_descripton))
+			# check datatype, suffix and entity names now, labels when a series matches
+			entity_chain(datatype = datatype, suffix = suffix, nonstandard = nonstandard, 
+				**{k: 'x' for k in list(chain) + [g for g in regex.groupindex if g in entities]})
+			self.rules.append({'pattern': series_descripton, 'match': match, 'regex': regex,
+				'datatype': datatype, 'suffix': suffix, 'nonstandard': nonstandard, 'entities': chain})
+
+		else:
+			raise ValueError('Unknown match {}, should be exact, regex or glob'.format(match))
+
+		self.matcher = None
+		self.matched = dict()
+
+	def Compile(self):
+		# one alternation, group names made unique per rule: r<i> around
+		# rule i, r<i>_<name> for its named groups
+		parts = list()
+		# number of rule i's r<i> group, its own groups follow
+		offset = 1
+		for i, rule in enumerate(self.rules):
+			pattern = rule['regex'].pattern
+			flags = re.match(r'\(\?([aiLmsux]+)\)', pattern)
+			if flags:
+				# global flags are only allowed at the very start, scope them
+				pattern = '(?{}:{})'.format(flags.group(1), pattern[flags.end():])
+
+			def rename(m, i = i, offset = offset):
+				name, ref, number, condition = m.groups()
+				if name:
+					return '(?P<r{}_{}>'.format(i, name)
+				if ref:
+					return '(?P=r{}_{})'.format(i, ref)
+				if number:
+					if offset + int(number) > 99:
+						raise ValueError('Rule {} backreference \\{} is past group 99 of all rules'.format(
+							rule['pattern'], number))
+					return '(?:\\{})'.format(offset + int(number))
+				if condition:
+					if condition.isdigit():
+						return '(?({})'.format(offset + int(condition))
+					return '(?(r{}_{})'.format(i, condition)
+				# any other escape, e.g. \\ or \(, is kept as it is
+				return m.group(0)
+
+			pattern = re.sub(r'\(\?P<(\w+)>|\(\?P=(\w+)\)|\\([1-9][0-9]?)(?![0-9])|\(\?\((\w+)\)|\\.', 
+				rename, pattern)
+			parts.append('(?P<r{}>{})'.format(i, pattern))
+			offset += rule['regex'].groups + 1
+		self.matcher = re.compile('|'.join(parts)) if parts else None
+
+	def Lookup(self, series_name):
+		"""entity_chain for series_name, None if nothing matches"""
+		if series_name in self.dictionary:
+			return self.dictionary[series_name]
+		if series_name in self.matched:
+			return self.matched[series_name]
+
+		if self.rules and not self.matcher:
+			self.Compile()
+
+		echain = None
+		m = self.matcher.fullmatch(series_name) if self.matcher else None
+		if m:
+			# the rule's own group closes last
+			i = int(m.lastgroup[1:])
+			rule = self.rules[i]
+			first = self.matcher.groupindex[m.lastgroup]
+			groups = [g or '' for g in m.groups()[first:first + rule['regex'].groups]]
+			named = {g: m.group('r{}_{}'.format(i, g)) or '' for g in rule['regex'].groupindex}
+
+			chain = {k: v for k, v in named.items() if k in entities and v}
+			chain.update({k: str(v).format(series_name, *groups, **named) for k, v in rule['entities'].items()})
+			chain = {k: re.sub('[^0-9a-zA-Z]+', '', v) for k, v in chain.items()}
+			try:
+				echain = entity_chain(datatype = rule['datatype'], suffix = rule['suffix'], 
+					nonstandard = rule['nonstandard'], **chain)
+			except ValueError as e:
+				raise ValueError('Series {} matched {}: {}'.format(series_name, rule['pattern'], e))
+
+		self.matched[series_name] = echain
+		return echain
 		
 	def __str__(self):
 		return_string = str()
 		for series in self.dictionary:
 			return_string += '{}: {}\n'.format(series, self.dictionary[series])
+		for rule in self.rules:
+			return_string += '{} ({}): {}/{} {}\n'.format(rule['pattern'], rule['match'], 
+				rule['datatype'], rule['suffix'], rule['entities'])
 		return return_string
 
 	def __repr__(self):
 		return_string = str()
 		for series in self.dictionary:
 			return_string += '{}: {}\n'.format(series, self.dictionary[series].__repr__())
+		for rule in self.rules:
+			return_string += '{} ({}): datatype: {}, suffix: {}, entities: {}\n'.format(rule['pattern'], 
+				rule['match'], rule['datatype'], rule['suffix'], rule['entities'])
 		return return_string
 
 def WriteDescription(subjectdir, bidsdir):
@@ -131,140 +420,722 @@ def WriteDescription(subjectdir, bidsdir):
 		with open(description_file, 'w') as f:
 			json.dump(j, f)
 
-def AppendParticipant(subjectdir, bidsdir):
-	if not os.path.exists(bidsdir):
-		os.makedirs(bidsdir)
-
-	name = GetSubjectName(subjectdir)
-	# check for name in .tsv first
-	part_file = os.path.join(bidsdir, 'participants.tsv')
-
-	if os.path.exists(part_file):
-		with open(part_file) as tsvfile:
-			reader = csv.DictReader(tsvfile, dialect='excel-tab')
-			
-			# get the field name
-			fieldnames = reader.fieldnames
-			
-			subjects = [row['participant_id'] for row in reader]
-		# return if this subject is already there
-		if 'sub-{}'.format(name) in subjects:
-			return
-		
-	else: # create new tsv/json files
-		fieldnames = ['participant_id', 'age', 'sex']
-		with open(part_file, 'w') as tsvfile:
-			writer = csv.DictWriter(tsvfile, fieldnames, dialect='excel-tab', 
-				extrasaction = 'ignore')
-			writer.writeheader()
+# DICOM age string (e.g. 030Y, 006M) in years
+def DicomAge(age):
+	if age.endswith('Y'):
+		return int(age[:-1])
+	return round(int(age[:-1]) / {'M': 12, 'W': 52, 'D': 365}[age[-1]], 1)
+
+# participants.tsv columns: (dicom keyword, conversion, participants.json entry)
+participant_fields = {
+	'age': ('PatientAge', DicomAge, {'Description': 'age of participant', 'Units': 'years'}),
+	'sex': ('PatientSex', str, {'Description': 'sex of participant', 
+		'Levels': {'M': 'male', 'F': 'female', 'O': 'other'}}),
+	'weight': ('PatientWeight', float, {'Description': 'weight of participant', 'Units': 'kg'}),
+	'height': ('PatientSize', float, {'Description': 'height of participant', 'Units': 'm'}),
+	'scan_date': ('StudyDate', lambda d: '{}-{}-{}'.format(d[:4], d[4:6], d[6:8]), 
+		{'Description': 'date of the scan session'})}
+
+# one participants.tsv row from the header of any dicom of the subject,
+# only the tags needed for columns are read
+def ReadDemographics(subjectdir, columns = ['age', 'sex']):
+	import pydicom
+
+	row = {'participant_id': 'sub-{}'.format(GetSubjectName(subjectdir))}
+	dcmfile = next(glob.iglob(os.path.join(subjectdir, 'Series*', '*.dcm')), None)
+	if not dcmfile:
+		return row
+	ds = pydicom.dcmread(dcmfile, stop_before_pixels = True, 
+		specific_tags = [participant_fields[c][0] for c in columns])
+	for column in columns:
+		keyword, conversion, description = participant_fields[column]
+		value = ds.get(keyword)
+		try:
+			row[column] = conversion(value) if value not in [None, ''] else 'n/a'
+		except (TypeError, ValueError, KeyError, IndexError):
+			row[column] = 'n/a'
+	return row
+
+def AppendParticipants(subjectdirs, bidsdir, columns = ['age', 'sex'], threads = 8):
+	"""add the subjects that aren't in bidsdir/participants.tsv yet
+
+	Headers are read threads at a time, one header-only read per subject
+	for all columns (see participant_fields). Columns that an existing
+	participants.tsv doesn't have are added, n/a for subjects already there.
+	"""
+	with Timed('AppendParticipants', subjects = len(subjectdirs), threads = threads) as record:
+		if not os.path.exists(bidsdir):
+			os.makedirs(bidsdir)
+
+		part_file = os.path.join(bidsdir, 'participants.tsv')
 		json_file = os.path.join(bidsdir, 'participants.json')
-		j = {'age': {'Description': 'age of participant', 'Units': 'years'}, 
-		'sex': {'Description': 'sex of participant', 'Levels': {'M': 'male', 'F': 'female', 'O': 'other'}}}
-		with open(json_file, 'w') as f:
-			json.dump(j, f)
+		fieldnames = ['participant_id'] + list(columns)
+		rows = list()
+		rewrite = True
+
+		if os.path.exists(part_file):
+			with open(part_file) as tsvfile:
+				reader = csv.DictReader(tsvfile, dialect='excel-tab')
+				rows = list(reader)
+			new_columns = [c for c in columns if c not in reader.fieldnames]
+			fieldnames = reader.fieldnames + new_columns
+			rewrite = bool(new_columns)
+
+		# check for names in .tsv first
+		subjects = set(row['participant_id'] for row in rows)
+		todo = list()
+		for subjectdir in subjectdirs:
+			name = 'sub-{}'.format(GetSubjectName(subjectdir))
+			if name not in subjects:
+				subjects.add(name)
+				todo.append(subjectdir)
+
+		with Accumulate(record, 'header_read'):
+			if threads and int(threads) > 1 and len(todo) > 1:
+				from concurrent.futures import ThreadPoolExecutor
+				with ThreadPoolExecutor(int(threads)) as pool:
+					new_rows = list(pool.map(lambda d: ReadDemographics(d, columns), todo))
+			else:
+				new_rows = [ReadDemographics(d, columns) for d in todo]
+		record['added'] = len(new_rows)
+
+		if rewrite:
+			# new file, or new columns: write it all
+			with open(part_file, 'w') as tsvfile:
+				writer = csv.DictWriter(tsvfile, fieldnames, dialect='excel-tab', 
+					extrasaction = 'ignore', restval = 'n/a')
+				writer.writeheader()
+				writer.writerows(rows + new_rows)
+		elif new_rows:
+			with open(part_file, 'a') as tsvfile:
+				writer = csv.DictWriter(tsvfile, fieldnames, dialect='excel-tab', 
+					extrasaction = 'ignore', restval = 'n/a')
+				writer.writerows(new_rows)
+
+		j = dict()
+		if os.path.exists(json_file):
+			with open(json_file) as f:
+				j = json.load(f)
+		if any(c not in j for c in fieldnames if c in participant_fields):
+			j.update({c: participant_fields[c][2] for c in fieldnames if c in participant_fields and c not in j})
+			with open(json_file, 'w') as f:
+				json.dump(j, f)
+
+def AppendParticipant(subjectdir, bidsdir, columns = ['age', 'sex']):
+	AppendParticipants([subjectdir], bidsdir, columns = columns, threads = 1)
 
+def Convert(dicomdir, bidsdir, bids_dict, slurm = False, participant_file = True, description_file = True,
+	json_mod = None, dcm2niix_flags = '', throttle = False, account = None, 
+	lmod = ['dcm2niix', 'jq'], threads = 1, njobs = None, timings = None, stage = False, 
+	logdir = None, capture = True, participant_columns = ['age', 'sex'], resume = True):
+	"""convert every subject under dicomdir
+
+	By default each subject is one script (one slurm job). With njobs 
+	and slurm, the series of all subjects are packed by estimated cost 
+	into njobs array tasks instead; timings (dict or log file glob of 
+	earlier runs) improves the estimate. stage copies each series to node 
+	local scratch ($TMPDIR) and converts there.
+
+	With capture, every series' dcm2niix/jq output, exit code and timing 
+	goes to a log in logdir (default bidsdir/code/mrpyconvert/logs/<time>).
+	Local runs write logdir/results.csv and print a summary when done; for
+	slurm runs call CollectResults(logdir) once the jobs finish.
+
+	participant_columns: participants.tsv columns, any of the keys of 
+	mrpyconvert.participant_fields
+
+	Finished series are journaled in bidsdir/code/mrpyconvert/journal. With
+	resume, series an earlier run finished (same dicoms, names and flags,
+	output still there) are skipped, so a run that was killed or timed out
+	carries on where it stopped. resume = False converts everything again.
+	"""
+
+	if capture and not logdir:
+		logdir = os.path.join(bidsdir, 'code', 'mrpyconvert', 'logs', time.strftime('%Y%m%d-%H%M%S'))
+	elif not capture:
+		logdir = None
+
+	with Timed('Convert', dicomdir = dicomdir, bidsdir = bidsdir) as record:
+		with Accumulate(record, 'scan'):
+			plan = MakePlan(dicomdir, bidsdir, bids_dict, json_mod = json_mod, dcm2niix_flags = dcm2niix_flags)
+		record['subjects'] = len(plan.subjectdirs)
+		record['series'] = len(plan)
+		subjectdirs = plan.subjectdirs
+
+		if not subjectdirs:
+			raise ValueError('Unable to find subject level directories. Are dicoms in lcni standard directory structure? You may need to run mrpyconvert.SortDicoms({}) first.'.format(dicomdir))
+
+		# e.g. two sessions of one subject without a ses entity
+		plan.CheckCollisions()
+
+		journal_dir = JournalDir(bidsdir)
+		if resume:
+			todo = plan.Resume(journal_dir)
+			if len(todo) < len(plan):
+				print('{} of {} series already converted'.format(len(plan) - len(todo), len(plan)))
+			plan = todo
+			record['resumed'] = record['series'] - len(plan)
+
+		if not plan:
+			print('Nothing to convert')
+			return None
+
+		if not os.path.exists(bidsdir):
+			os.makedirs(bidsdir)
+
+		if description_file:
+			WriteDescription(subjectdirs[0], bidsdir)
 
-	# get any dicom file
-	dcmfile = next(x for x in glob.glob(os.path.join(subjectdir,
-		'Series*', '*.dcm')))
-	ds = pydicom.dcmread(dcmfile)
+		if participant_file:
+			with Accumulate(record, 'participants'):
+				AppendParticipants(sorted(subjectdirs), bidsdir, columns = participant_columns, threads = 8)
+
+		if slurm and njobs:
+			plan.EstimateCosts(timings)
+			with Accumulate(record, 'submit'):
+				return plan.Run('slurm', threads = threads, njobs = njobs, lmod = lmod, account = account, stage = stage,
+					logdir = logdir, scriptdir = os.path.join(bidsdir, 'code', 'mrpyconvert'), journal_dir = journal_dir)
+
+		subject_plans = plan.BySubject()
+
+		for subjectdir in sorted(subject_plans):
+
+			with Accumulate(record, 'generate'):
+				command = subject_plans[subjectdir].Script(threads = threads, lmod = lmod, stage = stage,
+					logdir = logdir, journal = os.path.join(journal_dir, '{}_{}.tsv'.format(
+					time.strftime('%Y%m%d-%H%M%S'), os.path.basename(subjectdir))))
+
+			if slurm:
+				import slurmpy
+				job = slurmpy.SlurmJob(jobname = 'convert', command = command, account = account,
+					threads = threads)
+				filename = tempfile.NamedTemporaryFile().name
+				job.WriteSlurmFile(filename = filename)
+				with Accumulate(record, 'submit'):
+					job.SubmitSlurmFile()
+				if throttle:
+					slurmpy.SlurmThrottle() # Mike's helper script, helps with large # of submissions
 
-	with open(part_file, 'a') as tsvfile:
-		writer = csv.DictWriter(tsvfile, fieldnames, dialect='excel-tab', 
-			extrasaction = 'ignore')
-		writer.writerow({'participant_id': 'sub-{}'.format(name), 
-			'sex':ds.PatientSex, 'age':int(ds.PatientAge[:-1])})
-	return
+			else:
+				#print(command)
+				with Accumulate(record, 'run'):
+					process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, shell = True,
+						executable = '/bin/bash')
 
-def Convert(dicomdir, bidsdir, bids_dict, slurm = False, participant_file = True, description_file = True,
-	json_mod = None, dcm2niix_flags = '', throttle = False, account = None, 
-	lmod = ['dcm2niix', 'jq']):
+		# no logdir if every series was already converted
+		if not slurm and logdir and os.path.isdir(logdir):
+			return CollectResults(logdir, os.path.join(logdir, 'results.csv'))
 
-	subjectdirs = [x[0] for x in os.walk(dicomdir) if subject_pattern.match(os.path.basename(x[0].strip('/')))]
-	
-	if not subjectdirs:
-		raise ValueError('Unable to find subject level directories. Are dicoms in lcni standard directory structure? You may need to run dicom2bids.SortDicoms({}) first.'.format(dicomdir))
 
-	if not os.path.exists(bidsdir):
-		os.makedirs(bidsdir)
 
-	if description_file:
-		WriteDescription(subjectdirs[0], bidsdir)
 
-	command_base = ''
-	for mod in lmod:
-		command_base += 'module load {}\n'.format(mod)
 
-	for subjectdir in sorted(subjectdirs):
+def GenerateCSCommand(subjectdir, bidsdir, bids_dict, json_mod = None, dcm2niix_flags = '', threads = 1, 
+	stage = False):
 
-		if participant_file:
-			AppendParticipant(subjectdir, bidsdir)
+	with Timed('GenerateCSCommand', subject = subjectdir) as record:
+		plan = conversion_plan(PlanSubject(subjectdir, bidsdir, bids_dict, json_mod = json_mod,
+			dcm2niix_flags = dcm2niix_flags))
+		plan.CheckCollisions()
+		record['series'] = len(plan)
+		return plan.Script(threads = threads, stage = stage)
 
-		command = command_base + GenerateCSCommand(subjectdir = subjectdir, bidsdir = bidsdir, bids_dict = bids_dict,
-			json_mod = json_mod, dcm2niix_flags = dcm2niix_flags)
 
-		if slurm:
-			import slurmpy
-			job = slurmpy.SlurmJob(jobname = 'convert', command = command, account = account)
-			filename = tempfile.NamedTemporaryFile().name
-			job.WriteSlurmFile(filename = filename)
-			job.SubmitSlurmFile()
-			if throttle:
-				slurmpy.SlurmThrottle() # Mike's helper script, helps with large # of submissions
+# one dcm2niix conversion: where the dicoms are, where the nifti goes, 
+# what it's called and what to do to the json afterwards
+class series_task:
+	def __init__(self, subjectdir, series, output_dir, filename, datatype, 
+		json_patches = None, post = None, dcm2niix_flags = '', ndicoms = 0, nbytes = 0,
+		cost = None):
+
+		self.subjectdir = subjectdir
+		self.series = series
+		self.output_dir = output_dir
+		self.filename = filename
+		self.datatype = datatype
+		self.json_patches = json_patches if json_patches else dict()
+		# post steps touch whole output directories, so they run once
+		# after every series in a script has finished
+		self.post = post if post else list()
+		self.dcm2niix_flags = dcm2niix_flags
+		self.ndicoms = ndicoms
+		self.nbytes = nbytes
+		# estimated seconds, see conversion_plan.EstimateCosts
+		self.cost = cost
 
+	def __repr__(self):
+		return '{} --> {} ({} dicoms)'.format(self.input_dir, self.OutputPath(), self.ndicoms)
+
+	@property
+	def input_dir(self):
+		return os.path.join(self.subjectdir, self.series)
+
+	def OutputPath(self, extension = '.nii.gz'):
+		return os.path.join(self.output_dir, self.filename + extension)
+
+	def OutputExists(self):
+		return bool(glob.glob(os.path.join(self.output_dir, self.filename + '.nii*')))
+
+	def Command(self, stage = False):
+		"""bash commands for this conversion
+
+		stage: copy the dicoms to node local scratch ($TMPDIR) with one 
+		tar stream, convert there, then move the outputs back. Outputs are 
+		copied under a temporary name and renamed, so they appear atomically.
+		"""
+		if not stage:
+			command = 'mkdir -p "{}"\n'.format(self.output_dir)
+			command += 'dcm2niix -ba n -l o -o "{}" -f {} {} "{}"\n'.format(self.output_dir,
+				self.filename, self.dcm2niix_flags, self.input_dir)
+			command += 'rc=$?\n'
+			command += Marker('dcm2niix_end', self.input_dir, status = '$rc')
+
+			json_file = self.OutputPath('.json')
+			for key in self.json_patches:
+				command += FixJson(json_file, key, self.json_patches[key])
+
+			return command
+
+		command = 'stage=$(mktemp -d "${TMPDIR:-/tmp}/mrpyconvert.XXXXXX")\n'
+		command += 'mkdir -p "$stage/out"\n'
+		command += 'tar -C "{}" -cf - "{}" | tar -C "$stage" -xf -\n'.format(self.subjectdir, self.series)
+		command += Marker('stage_in_end', self.input_dir)
+		command += 'dcm2niix -ba n -l o -o "$stage/out" -f {} {} "$stage/{}"\n'.format(
+			self.filename, self.dcm2niix_flags, self.series)
+		command += 'rc=$?\n'
+		command += Marker('dcm2niix_end', self.input_dir, status = '$rc')
+
+		json_file = '$stage/out/{}.json'.format(self.filename)
+		for key in self.json_patches:
+			command += FixJson(json_file, key, self.json_patches[key])
+
+		command += 'mkdir -p "{}"\n'.format(self.output_dir)
+		command += 'for x in "$stage"/out/*\n'
+		command += 'do cp "$x" "{0}/.${{x##*/}}.partial" && mv -f "{0}/.${{x##*/}}.partial" "{0}/${{x##*/}}"\n'.format(self.output_dir)
+		command += 'done\n'
+		command += 'rm -rf "$stage"\n'
+		return command
+
+	def ToDict(self):
+		return dict(vars(self))
+
+	def Key(self):
+		"""identifies this conversion in the journal: changes with anything
+		that changes the output (flags, names, patches, dicoms)"""
+		task = self.ToDict()
+		del task['cost']
+		return hashlib.blake2b(json.dumps(task, sort_keys = True).encode(), digest_size = 8).hexdigest()
+
+	def JournalCommand(self, journal):
+		"""bash commands appending key, input, output and output size to 
+		journal if the conversion worked"""
+		command = 'if [ "$rc" -eq 0 ]; then\n'
+		command += 'out=$(ls "{}/{}".nii* 2>/dev/null | head -n 1)\n'.format(self.output_dir, self.filename)
+		command += '[ -n "$out" ] && printf \'%s\\t%s\\t%s\\t%s\\n\' {} "{}" "$out" "$(stat -c %s "$out")" >> "{}"\n'.format(
+			self.Key(), self.input_dir, journal)
+		command += 'fi\n'
+		return command
+
+	def Size(self):
+		"""relative size of the conversion: bytes plus a per-file overhead"""
+		return self.nbytes + file_overhead * self.ndicoms
+
+	def Cost(self):
+		return self.cost if self.cost is not None else self.Size()
+
+
+# bytes-equivalent cost of opening one small file when estimating series cost
+file_overhead = 256 * 1024
+
+# a list of series_tasks that can be inspected, saved, split and run
+class conversion_plan:
+	def __init__(self, tasks = None, subjectdirs = None):
+		self.tasks = list()
+		self.duplicates = list()
+		# output path -> task
+		self.outputs = dict()
+		# every subject directory scanned, including ones with no matching series
+		self.subjectdirs = subjectdirs if subjectdirs else list()
+		for task in (tasks if tasks else list()):
+			self.add(task)
+
+	def add(self, task):
+		# two series mapping to the same output would overwrite each other
+		if task.OutputPath() in self.outputs:
+			self.duplicates.append(task)
 		else:
-			#print(command)
-			process = subprocess.run(command, stdout=subprocess.PIPE, stderr=subprocess.STDOUT, universal_newlines=True, shell = True)
+			self.outputs[task.OutputPath()] = task
+			self.tasks.append(task)
+
+	def Collisions(self):
+		"""dict of output path -> input directories of every series that 
+		maps to it, for the outputs more than one series maps to"""
+		collisions = dict()
+		for task in self.duplicates:
+			path = task.OutputPath()
+			collisions.setdefault(path, [self.outputs[path].input_dir]).append(task.input_dir)
+		return collisions
+
+	def CheckCollisions(self):
+		"""raise ValueError listing the collisions, if there are any"""
+		collisions = self.Collisions()
+		if collisions:
+			error_string = 'Series would overwrite each other:\n'
+			for path in collisions:
+				error_string += '{}: {}\n'.format(path, ', '.join(collisions[path]))
+			raise ValueError(error_string)
+
+	def __len__(self):
+		return len(self.tasks)
+
+	def __iter__(self):
+		return iter(self.tasks)
 
+	def __str__(self):
+		return_string = str()
+		for task in self.tasks:
+			return_string += '{}\n'.format(task.__repr__())
+		return return_string
 
+	def BySubject(self):
+		plans = dict()
+		for task in self.tasks:
+			plans.setdefault(task.subjectdir, conversion_plan()).add(task)
+		return plans
+
+	def Pending(self):
+		"""plan with only the tasks whose output doesn't exist yet"""
+		return conversion_plan([t for t in self.tasks if not t.OutputExists()])
+
+	def Resume(self, journal_dir):
+		"""plan without the tasks an earlier run finished, according to the
+		journals in journal_dir (see ReadConvertJournal)"""
+		done = ReadConvertJournal(journal_dir)
+		return conversion_plan([t for t in self.tasks if t.Key() not in done], 
+			subjectdirs = self.subjectdirs)
+
+	def EstimateCosts(self, timings = None):
+		"""set each task's cost in seconds
+
+		timings: dict of input directory -> measured seconds from earlier 
+		runs, or log files to read them from (see ReadTimings). Measured 
+		series use their own time, the rest are scaled from their size by 
+		the seconds per size of the measured ones.
+		"""
+		if timings is None:
+			timings = dict()
+		elif type(timings) is not dict:
+			timings = ReadTimings(timings)
+
+		measured = [t for t in self.tasks if t.input_dir in timings]
+		size = sum(t.Size() for t in measured)
+		rate = sum(timings[t.input_dir] for t in measured) / size if size else 1
+
+		for task in self.tasks:
+			if task.input_dir in timings:
+				task.cost = timings[task.input_dir]
+			else:
+				task.cost = task.Size() * rate
+
+	def Split(self, n):
+		"""split into at most n plans with balanced cost
+
+		Longest processing time first: tasks are taken largest first and 
+		each goes to the currently least loaded chunk, which keeps the 
+		largest chunk within 4/3 of the ideal makespan.
+		"""
+		import heapq
+		n = max(1, min(n, len(self.tasks)))
+		chunks = [conversion_plan() for i in range(n)]
+		loads = [(0, i) for i in range(n)]
+		for task in sorted(self.tasks, key = lambda t: t.Cost(), reverse = True):
+			load, i = heapq.heappop(loads)
+			chunks[i].add(task)
+			heapq.heappush(loads, (load + task.Cost(), i))
+		return [c for c in chunks if len(c)]
+
+	def Cost(self):
+		return sum(t.Cost() for t in self.tasks)
+
+	def Script(self, threads = 1, lmod = None, stage = False, logdir = None, journal = None):
+		"""bash script for the whole plan, series run threads at a time
+		stage: convert in node local scratch, see series_task.Command
+		logdir: write each series' output to logdir/<bids filename>.log,
+		see CollectResults
+		journal: append each finished series to this file (see Resume),
+		fsynced every journal_sync series. Outputs a killed run left are
+		removed before a series is converted."""
+		command = Marker('script_start', 'script')
+		for mod in (lmod if lmod else list()):
+			command += 'module load {}\n'.format(mod)
+
+		if logdir:
+			command += 'mkdir -p "{}"\n'.format(logdir)
+		if journal:
+			command += 'mkdir -p "{}"\n'.format(os.path.dirname(journal))
+
+		for i, task in enumerate(self.tasks):
+			block = task.Command(stage = stage)
+			if journal:
+				block = 'rm -f "{}/{}".*\n'.format(task.output_dir, task.filename) + block
+			block = '(\n{})'.format(TimeBlock(block, task.input_dir) + 
+				(task.JournalCommand(journal) if journal else ''))
+			if logdir:
+				block += ' > "{}" 2>&1'.format(os.path.join(logdir, task.filename + '.log'))
+			if threads and int(threads) > 1:
+				command += ThrottleJobs(threads)
+				command += block + ' &\n'
+			else:
+				command += block + '\n'
+			if journal and (i + 1) % journal_sync == 0:
+				command += 'sync "{}"\n'.format(journal)
+
+		if threads and int(threads) > 1:
+			command += 'wait\n'
+		if journal:
+			command += 'sync "{}"\n'.format(journal)
+
+		post = list()
+		for task in self.tasks:
+			post += [p for p in task.post if p not in post]
+		command += ''.join(post)
+		command += Marker('script_end', 'script')
+
+		return command
+
+	def Save(self, filename):
+		with open(filename, 'w') as f:
+			json.dump([t.ToDict() for t in self.tasks], f, indent = 1)
+		return filename
+
+	def Run(self, executor = 'serial', threads = 1, njobs = 1, dry_run = False, 
+		lmod = ['dcm2niix', 'jq'], scriptdir = None, stage = False, logdir = None, 
+		journal_dir = None, **slurm_params):
+		"""run the plan
+
+		executor: 'serial' runs one series at a time, 'local' runs threads
+		series at a time on this machine, 'slurm' submits a job array of 
+		njobs balanced chunks, each running threads series at a time. 
+		dry_run prints what would be done instead. stage converts in node
+		local scratch. logdir keeps each series' output (see CollectResults).
+		journal_dir gets a journal per script, see Resume. An empty plan
+		runs and submits nothing and returns None.
+		"""
+		stamp = time.strftime('%Y%m%d-%H%M%S')
+		if dry_run:
+			print(self)
+			return
 
+		if not self.tasks:
+			return None
 
+		if executor in ['serial', 'local']:
+			if executor == 'serial':
+				threads = 1
+			journal = os.path.join(journal_dir, '{}.tsv'.format(stamp)) if journal_dir else None
+			return subprocess.run(self.Script(threads = threads, lmod = lmod, stage = stage, logdir = logdir,
+				journal = journal), stdout=subprocess.PIPE, 
+				stderr=subprocess.STDOUT, universal_newlines=True, shell = True, executable = '/bin/bash')
 
+		elif executor == 'slurm':
+			import slurmpy
+			# chunk scripts have to be somewhere the compute nodes can see
+			if not scriptdir:
+				scriptdir = os.path.join(os.getcwd(), 'convert_scripts')
+			os.makedirs(scriptdir, exist_ok = True)
+			# a directory per run, queued arrays of earlier runs still read theirs
+			rundir = tempfile.mkdtemp(prefix = stamp + '_', dir = scriptdir)
+			scripts = list()
+			for i, chunk in enumerate(self.Split(njobs)):
+				scripts.append(os.path.join(rundir, 'chunk_{:04d}.sh'.format(i)))
+				journal = os.path.join(journal_dir, '{}_{:04d}.tsv'.format(stamp, i)) if journal_dir else None
+				with open(scripts[-1], 'w') as f:
+					f.write(chunk.Script(threads = threads, lmod = lmod, stage = stage, logdir = logdir, 
+						journal = journal))
+			job = slurmpy.SlurmJob(jobname = 'convert', command = 'bash "${x}"', array = scripts,
+				threads = threads, **slurm_params)
+			# with the chunk scripts, the tasks read this run's array manifest
+			job.WriteSlurmFile(filename = os.path.join(rundir, 'convert.srun'))
+			return job.SubmitSlurmFile()
 
-def GenerateCSCommand(subjectdir, bidsdir, bids_dict, json_mod = None, dcm2niix_flags = ''):
+		else:
+			raise ValueError('Unknown executor {}'.format(executor))
 
-	name = GetSubjectName(subjectdir)
 
-	command = ''
+# Convert's journals, see conversion_plan.Script and Resume
+journal_sync = 20
 
-	subj_dir = os.path.join(bidsdir, 'sub-{}'.format(name))
-	series_dirs = os.listdir(subjectdir)
+def JournalDir(bidsdir):
+	return os.path.join(bidsdir, 'code', 'mrpyconvert', 'journal')
 
-	for series in series_dirs:
-		run, series_name = re.match(series_pattern, series).groups()
-		output_dir = None
-		if series_name in bids_dict.dictionary:
-			echain = bids_dict.dictionary[series_name]
+# keys of the conversions journaled in journal_dir whose output is still
+# there with the size it had when it was journaled
+def ReadConvertJournal(journal_dir):
+	done = set()
+	for journal_file in glob.glob(os.path.join(journal_dir, '*.tsv')):
+		for key, input_dir, output, size in ReadJournal(journal_file, 4):
+			try:
+				if os.path.getsize(output) == int(size):
+					done.add(key)
+			except (OSError, ValueError):
+				continue
+	return done
 
-			if 'ses' in echain.chain:
-				output_dir = os.path.join(subj_dir, 'ses-{}'.format(echain.chain['ses']),
-					echain.datatype)
-			else:
-				output_dir = os.path.join(subj_dir, echain.datatype)
+def LoadPlan(filename):
+	with open(filename) as f:
+		return conversion_plan([series_task(**t) for t in json.load(f)])
 
-			echain.chain['run'] = '{:02d}'.format(int(run))
-			format_string = echain.GetFormatString().format(name)
 
-			if not os.path.exists(output_dir):
-				os.makedirs(output_dir)
+# list of series_tasks for one subject directory
+# catalog: from ScanDicomDir, scanned here if not given
+def PlanSubject(subjectdir, bidsdir, bids_dict, json_mod = None, dcm2niix_flags = '', catalog = None):
 
-			command += 'dcm2niix -ba n -l o -o "{}" -f {} {} "{}"\n'.format(output_dir,
-						format_string, dcm2niix_flags, os.path.join(subjectdir, series))
+	name = GetSubjectName(subjectdir)
+	tasks = list()
 
-			json_file = os.path.join(output_dir, format_string + '.json')
-			if 'task' in echain.chain:
-				command += FixJson(json_file, 'TaskName', echain.chain['task'])
+	if catalog is None:
+		catalog = ScanDicomDir(subjectdir)
+	series_dirs = catalog[os.path.normpath(subjectdir)]
+
+	for series in sorted(series_dirs):
+		run, series_name = re.match(series_pattern, series).groups()
+		echain = bids_dict.Lookup(series_name)
+		if echain:
+			directory, format_string = echain.Render(name, run)
+			output_dir = os.path.join(bidsdir, directory)
 
+			json_patches = dict()
+			if 'task' in echain.chain:
+				json_patches['TaskName'] = echain.chain['task']
 			if json_mod:
-				for key in json_mod:
-					command += FixJson(json_file, key, json_mod[key])
+				json_patches.update(json_mod)
 
+			post = list()
 			if echain.datatype == 'dwi':
-				command += FixDwiFiles(output_dir)
+				post.append(FixDwiFiles(output_dir))
+
+			tasks.append(series_task(subjectdir = subjectdir, series = series,
+				output_dir = output_dir, filename = format_string, datatype = echain.datatype,
+				json_patches = json_patches, post = post, dcm2niix_flags = dcm2niix_flags,
+				**series_dirs[series]))
+
+	return tasks
+
+
+# conversion plan for every subject directory under dicomdir
+def MakePlan(dicomdir, bidsdir, bids_dict, json_mod = None, dcm2niix_flags = ''):
+	catalog = ScanDicomDir(dicomdir)
+
+	plan = conversion_plan(subjectdirs = sorted(catalog))
+	for subjectdir in plan.subjectdirs:
+		for task in PlanSubject(subjectdir, bidsdir, bids_dict, json_mod = json_mod,
+			dcm2niix_flags = dcm2niix_flags, catalog = catalog):
+			plan.add(task)
+
+	return plan
+
+
+# returns the command string to echo a JSON wall clock marker, e.g.
+# {"stage": "series_start", "label": "/path/Series_1_T1", "time": 1600000000.1}
+# status: optional bash expression for an exit code, e.g. '$rc'
+def Marker(stage, label, status = None):
+	fixed = json.dumps({'stage': stage, 'label': label})[:-1].replace("'", "'\\''")
+	if status:
+		return 'echo \'{}\'", \\"status\\": {}, \\"time\\": $(date +%s.%N)}}"\n'.format(fixed, status)
+	return 'echo \'{}\'", \\"time\\": $(date +%s.%N)}}"\n'.format(fixed)
+
+# wraps a block of commands with per-series wall clock markers
+def TimeBlock(block, label):
+	return Marker('series_start', label) + 'rc=0\n' + block + Marker('series_end', label, status = '$rc')
+
+# reads per-series times from the markers in job logs
+# returns dict of input directory -> seconds (latest run wins)
+def ReadTimings(logfiles):
+	if type(logfiles) is str:
+		logfiles = glob.glob(logfiles)
+	timings = dict()
+	for logfile in logfiles:
+		starts = dict()
+		with open(logfile, errors = 'replace') as f:
+			for line in f:
+				if not line.startswith('{"stage"'):
+					continue
+				try:
+					record = json.loads(line)
+				except ValueError:
+					continue
+				if record['stage'] == 'series_start':
+					starts[record['label']] = record['time']
+				elif record['stage'] == 'series_end' and record['label'] in starts:
+					timings[record['label']] = record['time'] - starts.pop(record['label'])
+	return timings
+
+# per-series results from the logs written with Script(logdir = ...)
+# results_file: .csv, or .db/.sqlite for an sqlite table named results
+# returns list of dicts, one per series log
+def CollectResults(logdir, results_file = None, summary = True):
+	results = list()
+	for logfile in sorted(glob.glob(os.path.join(logdir, '*.log'))):
+		result = {'series': None, 'status': 'incomplete', 'returncode': None, 'seconds': None,
+			'dcm2niix_seconds': None, 'warnings': 0, 'errors': 0, 'log': logfile}
+		start = None
+		with open(logfile, errors = 'replace') as f:
+			for line in f:
+				if line.startswith('{"stage"'):
+					try:
+						record = json.loads(line)
+					except ValueError:
+						continue
+					result['series'] = record['label']
+					if record['stage'] == 'series_start':
+						start = record['time']
+					elif record['stage'] == 'dcm2niix_end' and start:
+						result['dcm2niix_seconds'] = round(record['time'] - start, 3)
+					elif record['stage'] == 'series_end':
+						result['returncode'] = record.get('status')
+						result['status'] = 'ok' if result['returncode'] == 0 else 'failed'
+						if start:
+							result['seconds'] = round(record['time'] - start, 3)
+				elif line.lower().startswith('warning'):
+					result['warnings'] += 1
+				elif line.lower().startswith('error'):
+					result['errors'] += 1
+		results.append(result)
+
+	if results_file:
+		fieldnames = list(results[0]) if results else ['series']
+		if results_file.endswith(('.db', '.sqlite')):
+			import sqlite3
+			with sqlite3.connect(results_file) as db:
+				db.execute('create table if not exists results ({}, primary key (log))'.format(', '.join(fieldnames)))
+				db.executemany('insert or replace into results values ({})'.format(', '.join('?' * len(fieldnames))),
+					[[r[k] for k in fieldnames] for r in results])
+		else:
+			with open(results_file, 'w') as f:
+				writer = csv.DictWriter(f, fieldnames)
+				writer.writeheader()
+				writer.writerows(results)
 
+	if summary:
+		SummarizeResults(results)
 
+	return results
 
-	return command
+def SummarizeResults(results, nslowest = 10):
+	failed = [r for r in results if r['status'] != 'ok']
+	print('{} series, {} failed or incomplete, {} with warnings'.format(len(results), len(failed),
+		len([r for r in results if r['warnings']])))
+	for r in failed:
+		print('{}: {} (return code {}) see {}'.format(r['status'], r['series'], r['returncode'], r['log']))
+	timed = sorted([r for r in results if r['seconds'] is not None], key = lambda r: r['seconds'], reverse = True)
+	if timed:
+		print('slowest:')
+		for r in timed[:nslowest]:
+			print('{:10.1f}s {}'.format(r['seconds'], r['series']))
+
+# returns the command string to wait until fewer than n background jobs run
+def ThrottleJobs(n):
+	return 'while [ $(jobs -rp | wc -l) -ge {} ]; do wait -n; done\n'.format(n)
 
 
 # Given a path into the talapas dcm repo, generate a list of authors
@@ -302,53 +1173,870 @@ def FixDwiFiles(dirname):
 lcni_corrections = {'InstitutionName':'University of Oregon', 'InstitutionalDepartmentName':'LCNI', 'InstitutionAddress':'Franklin_Blvd_1440_Eugene_Oregon_US_97403'}
 
 
-def SortDicoms(input_dir, output_dir, overwrite = False, preview = False, slurm = False, account = None):
-
-	if slurm:
-		command = 'import dicom2bids\n'
-		command += 'dicom2bids.SortDicoms("{}","{}", overwrite = {}, preview = {}, slurm = False)'.format(input_dir, output_dir, overwrite, preview)
-
-		import slurmpy
-		filename = tempfile.NamedTemporaryFile().name
-		job = slurmpy.SlurmJob(jobname = 'sort', command = command, account = account)
-		job.WriteSlurmFile(filename = filename, interpreter = 'python')
-		return job.SubmitSlurmFile()
-
-	# Get the list of all files in directory tree at given path
+# archive extensions SortDicoms will read members from
+archive_extensions = ('.tar', '.tar.gz', '.tgz', '.tar.bz2', '.tbz2', '.tar.xz', '.txz', '.zip')
+
+def IsArchive(path):
+	return path.lower().endswith(archive_extensions)
+
+# SortDicoms memory use per file, whatever the size of the dicoms: only the
+# tags SortedName needs are parsed, any element bigger than defer_size is 
+# skipped over rather than read, files are copied and hashed copy_chunk at
+# a time, and compressed archive members bigger than sort_memory_limit are
+# spooled to disk ($TMPDIR) instead of memory
+sort_tags = ['PatientName', 'StudyDate', 'StudyTime', 'SeriesNumber', 'SeriesDescription', 'SOPInstanceUID']
+defer_size = 1024 * 1024
+copy_chunk = 1024 * 1024
+sort_memory_limit = 256 * 1024 * 1024
+
+# header only read for sorting
+def ReadSortHeader(f):
+	import pydicom
+	return pydicom.dcmread(f, stop_before_pixels = True, defer_size = defer_size, 
+		specific_tags = sort_tags)
+
+# yields (source, version, member name, dataset, copy function, hash function) 
+# for every dicom in a tar or zip archive. source is archive:member and 
+# version its size:mtime. copy(destination) writes the member out and 
+# returns its hash, so only members that are kept get extracted. At most max_memory bytes of a member
+# are held in memory. Members for which skip(source, version) is true are
+# skipped without being read.
+def ReadArchive(archive, max_memory = None, skip = None):
+	skip = skip if skip else lambda source, version: False
+	if not max_memory:
+		max_memory = sort_memory_limit
+
+	if archive.lower().endswith('.zip'):
+		import zipfile
+		with zipfile.ZipFile(archive) as zf:
+			for info in zf.infolist():
+				if info.is_dir():
+					continue
+				source = '{}:{}'.format(archive, info.filename)
+				version = '{}:{}'.format(info.file_size, '-'.join(str(x) for x in info.date_time))
+				if skip(source, version):
+					continue
+				try:
+					with zf.open(info) as f:
+						ds = ReadSortHeader(f)
+				except Exception:
+					print('Unable to read as dicom: ', '{}:{}'.format(archive, info.filename))
+					continue
+
+				def copy(destination, info = info):
+					with zf.open(info) as f:
+						return CopyHashed(f, destination)
+
+				def digest(info = info):
+					with zf.open(info) as f:
+						return HashStream(f)
+
+				yield source, version, info.filename, ds, copy, digest
+
+	else:
+		import tarfile
+		# stream mode: compressed archives are read once, front to back, 
+		# so each member is spooled (hashed on the way) to be read again
+		with tarfile.open(archive, 'r|*') as tf:
+			for member in tf:
+				if not member.isfile():
+					continue
+				# in stream mode members that aren't extracted are skipped over
+				version = '{}:{}'.format(member.size, member.mtime)
+				if skip('{}:{}'.format(archive, member.name), version):
+					continue
+				with tempfile.SpooledTemporaryFile(max_size = max_memory) as spool:
+					h = hashlib.blake2b(digest_size = 16)
+					data = tf.extractfile(member)
+					for block in iter(lambda: data.read(copy_chunk), b''):
+						h.update(block)
+						spool.write(block)
+					spool.seek(0)
+					try:
+						ds = ReadSortHeader(spool)
+					except Exception:
+						print('Unable to read as dicom: ', '{}:{}'.format(archive, member.name))
+						continue
+
+					content_hash = h.hexdigest()
+
+					def copy(destination, spool = spool, content_hash = content_hash):
+						spool.seek(0)
+						with open(destination, 'wb') as out:
+							shutil.copyfileobj(spool, out, copy_chunk)
+						return content_hash
+
+					yield ('{}:{}'.format(archive, member.name), version, member.name, ds, copy, 
+						lambda content_hash = content_hash: content_hash)
+
+# all files in the directory tree at input_dir (or input_dir if it's a file)
+def ListFiles(input_dir):
 	listOfFiles = list()
+	if os.path.isfile(input_dir):
+		listOfFiles.append(input_dir)
 	for (dirpath, dirnames, filenames) in os.walk(input_dir):
 		listOfFiles += [os.path.join(dirpath, file) for file in filenames]
-
-	duplicates = False
+	return listOfFiles
+
+# yields (source, version, name, dataset, copy function, hash function) for 
+# every dicom under input_dir, which may be a directory, an archive, a 
+# directory containing archives, or a list of files/archives. For plain 
+# files source and name are the path and version is size:mtime. Files 
+# for which skip(source, version) is true are skipped without being read.
+def ReadDicoms(input_dir, max_memory = None, skip = None):
+	if isinstance(input_dir, (list, tuple)):
+		listOfFiles = input_dir
+	else:
+		listOfFiles = ListFiles(input_dir)
 
 	for file in listOfFiles:
+		if IsArchive(file):
+			for x in ReadArchive(file, max_memory = max_memory, skip = skip):
+				yield x
+			continue
+
 		try:
-			ds = pydicom.dcmread(file)
+			st = os.stat(file)
+		except OSError:
+			continue
+		version = '{}:{}'.format(st.st_size, st.st_mtime)
+		if skip and skip(file, version):
+			continue
+
+		try:
+			ds = ReadSortHeader(file)
 		except:
 			print('Unable to read as dicom: ', file)
 			continue
 
-		subject = ds.PatientName
-		date = ds.StudyDate
-		time = ds.StudyTime.split('.')[0]
-		series_no = ds.SeriesNumber
-		series_desc = ds.SeriesDescription
-		  
-		  
-		newname = os.path.join(output_dir, '{}_{}_{}'.format(subject, date, time), 
-			'Series_{}_{}'.format(series_no, series_desc), os.path.basename(file))
-
-		if preview:
-			print(file, '-->', newname)
-
-		elif not overwrite and os.path.exists(newname):
-			duplicates = True
-		else:
-			os.makedirs(os.path.dirname(newname), exist_ok = True)
-			shutil.copyfile(file, newname)
+		def copy(destination, file = file):
+			with open(file, 'rb') as f:
+				return CopyHashed(f, destination)
+
+		yield file, version, file, ds, copy, lambda file = file: HashFile(file)
+
+# content hashes for SortDicoms deduplication
+def HashStream(f):
+	h = hashlib.blake2b(digest_size = 16)
+	for block in iter(lambda: f.read(copy_chunk), b''):
+		h.update(block)
+	return h.hexdigest()
+
+def HashFile(filename):
+	with open(filename, 'rb') as f:
+		return HashStream(f)
+
+# copy f to destination in chunks, returns its hash as HashStream would,
+# so a new file is read once
+def CopyHashed(f, destination):
+	h = hashlib.blake2b(digest_size = 16)
+	with open(destination, 'wb') as out:
+		for block in iter(lambda: f.read(copy_chunk), b''):
+			h.update(block)
+			out.write(block)
+	return h.hexdigest()
+
+# persistent SortDicoms index: one line per sorted file with its
+# SOPInstanceUID, content hash and path relative to output_dir
+sort_index_name = '.sortdicoms_index.tsv'
+
+def ReadSortIndex(output_dir):
+	index = dict()
+	index_file = os.path.join(output_dir, sort_index_name)
+	if os.path.exists(index_file):
+		with open(index_file) as f:
+			for row in csv.reader(f, dialect = 'excel-tab'):
+				if len(row) == 3:
+					index[row[0]] = (row[1], row[2])
+	return index
+
+# append-only tsv that survives the process being killed: rows are 
+# flushed and fsynced in batches, every sync_every rows or sync_seconds 
+# seconds, and on close. before is called ahead of each fsync, for a 
+# journal that must never be ahead of another one. A line torn by a kill 
+# is ended before anything is appended, and skipped by ReadJournal.
+class journal:
+	def __init__(self, filename, sync_every = 200, sync_seconds = 5, before = None):
+		os.makedirs(os.path.dirname(os.path.abspath(filename)), exist_ok = True)
+		torn = False
+		if os.path.exists(filename) and os.path.getsize(filename):
+			with open(filename, 'rb') as f:
+				f.seek(-1, 2)
+				torn = f.read(1) != b'\n'
+		self.file = open(filename, 'a', newline = '')
+		if torn:
+			self.file.write('\n')
+		self.writer = csv.writer(self.file, dialect = 'excel-tab')
+		self.sync_every = sync_every
+		self.sync_seconds = sync_seconds
+		self.before = before
+		self.pending = list()
+		self.last_sync = time.time()
+
+	def write(self, row):
+		# held here until the sync, so nothing reaches the file out of order
+		self.pending.append(row)
+		if len(self.pending) >= self.sync_every or time.time() - self.last_sync >= self.sync_seconds:
+			self.sync()
+
+	def sync(self):
+		if self.before:
+			self.before()
+		self.writer.writerows(self.pending)
+		self.file.flush()
+		os.fsync(self.file.fileno())
+		self.pending = list()
+		self.last_sync = time.time()
+
+	def close(self):
+		self.sync()
+		self.file.close()
+
+# rows of a journal with ncolumns columns
+def ReadJournal(filename, ncolumns):
+	rows = list()
+	if os.path.exists(filename):
+		with open(filename, newline = '') as f:
+			for row in csv.reader(f, dialect = 'excel-tab'):
+				if len(row) == ncolumns:
+					rows.append(row)
+	return rows
+
+# SortDicoms checkpoint, one line per source: source, version, status, 
+# output path relative to output_dir and its size if it was copied
+sort_journal_name = '.sortdicoms_journal.tsv'
+# where copies are made before they're renamed into place
+partial_dir_name = '.partial'
+# seconds untouched after which another host's partial copy is abandoned
+partial_stale = 24 * 3600
+
+# random.pid.host, so the copy's owner can be told from its name
+def PartialName(partial_dir):
+	os.makedirs(partial_dir, exist_ok = True)
+	return os.path.join(partial_dir, '{}.{}.{}'.format(os.urandom(8).hex(), os.getpid(), socket.gethostname()))
+
+# remove copies left in partial_dir by sorts that were killed: from this
+# host by a process that's gone, or from anywhere if untouched for 
+# partial_stale seconds. Copies concurrent sorts are making are left alone.
+def CleanPartials(partial_dir):
+	if not os.path.isdir(partial_dir):
+		return
+	host = socket.gethostname()
+	for name in os.listdir(partial_dir):
+		path = os.path.join(partial_dir, name)
+		fields = name.split('.', 2)
+		try:
+			if len(fields) == 3 and fields[2] == host:
+				try:
+					os.kill(int(fields[1]), 0)
+					continue
+				except ProcessLookupError:
+					pass
+				except (PermissionError, ValueError):
+					continue
+			elif time.time() - os.path.getmtime(path) < partial_stale:
+				continue
+			os.remove(path)
+		except OSError:
+			# finished and renamed meanwhile
+			pass
+
+# sizes of files (None if missing), to tell whether a copy of their 
+# content kept in memory is still current
+def FileSizes(files):
+	return [os.path.getsize(f) if os.path.exists(f) else None for f in files]
+
+# source -> (version, output, size) of what an earlier SortDicoms 
+# finished, see SortJournalDone
+def ReadSortJournal(journal_file):
+	done = dict()
+	for source, version, status, output, size in ReadJournal(journal_file, 5):
+		done[source] = (version, output, size)
+	return done
+
+# whether entry, from ReadSortJournal, says source is sorted as it is now.
+# Copies whose output is missing or the wrong size (killed, or changed 
+# since) are done again. Checked per source seen, the journal of a long 
+# lived output_dir can list far more outputs than a run looks at.
+def SortJournalDone(entry, version, output_dir):
+	if not entry or entry[0] != version:
+		return False
+	if entry[1]:
+		try:
+			return os.path.getsize(os.path.join(output_dir, entry[1])) == int(entry[2])
+		except (OSError, ValueError):
+			return False
+	return True
+
+# where SortDicoms puts a file
+def SortedName(ds, output_dir, filename):
+	subject = ds.PatientName
+	date = ds.StudyDate
+	time = ds.StudyTime.split('.')[0]
+	series_no = ds.SeriesNumber
+	series_desc = ds.SeriesDescription
+
+	return os.path.join(output_dir, '{}_{}_{}'.format(subject, date, time), 
+		'Series_{}_{}'.format(series_no, series_desc), os.path.basename(filename))
+
+# copy a file to newname without clobbering one another process put there
+# first (shards of a distributed sort share output_dir). The copy is made
+# in partial_dir and linked into place. Returns the name used, or None if
+# an identical file is already there, and the file's hash.
+def PlaceFile(copy, newname, partial_dir):
+	partial = PartialName(partial_dir)
+	content_hash = copy(partial)
+	root, ext = os.path.splitext(newname)
+	try:
+		for candidate in [newname, '{}_{}{}'.format(root, content_hash[:8], ext)]:
+			try:
+				# link fails if the name exists, rename would replace it
+				os.link(partial, candidate)
+				return candidate, content_hash
+			except FileExistsError:
+				if HashFile(candidate) == content_hash:
+					return None, content_hash
+		raise FileExistsError('{} exists with different content'.format(newname))
+	finally:
+		os.remove(partial)
+
+# planning pass for the distributed sort: split the files under input_dir 
+# into at most nshards lists, from directory listings only. by = 'dir' keeps
+# each directory (and each archive) in one shard and balances shards by 
+# size, by = 'files' splits the sorted file list into equal count ranges.
+def ShardInputs(input_dir, nshards, by = 'dir'):
+	if os.path.isfile(input_dir):
+		return [[input_dir]]
+
+	if by == 'files':
+		files = sorted(ListFiles(input_dir))
+		n = max(1, min(nshards, len(files)))
+		shards = [files[i * len(files) // n:(i + 1) * len(files) // n] for i in range(n)]
+		return [x for x in shards if x]
+
+	elif by != 'dir':
+		raise ValueError('Unknown shard_by {}'.format(by))
+
+	import heapq
+	# {directory or archive: [files, bytes]}
+	groups = dict()
+	def scan(path):
+		with os.scandir(path) as it:
+			for entry in it:
+				if entry.is_dir(follow_symlinks = False):
+					scan(entry.path)
+				elif entry.is_file():
+					group = groups.setdefault(entry.path if IsArchive(entry.name) else path, [[], 0])
+					group[0].append(entry.path)
+					group[1] += entry.stat().st_size
+	scan(input_dir)
+
+	n = max(1, min(nshards, len(groups)))
+	shards = [[] for i in range(n)]
+	loads = [(0, i) for i in range(n)]
+	for files, nbytes in sorted(groups.values(), key = lambda g: g[1], reverse = True):
+		load, i = heapq.heappop(loads)
+		shards[i] += sorted(files)
+		heapq.heappush(loads, (load + nbytes + file_overhead * len(files), i))
+	return [x for x in shards if x]
+
+def SubmitShardedSort(input_dir, output_dir, njobs, shard_by = 'dir', workdir = None, 
+	overwrite = False, max_memory = None, **slurm_params):
+	"""submit a distributed SortDicoms: a job array sorting njobs shards of
+	input_dir, and a reduce job (MergeSortManifests) that runs after it
+
+	workdir (default output_dir/.sortdicoms_shards/<time>) gets the shard 
+	lists, their manifests, the slurm logs and the final report.json
+
+	Returns
+	-------
+	jobid of the reduce job
+	"""
+	import sys
+	import slurmpy
+
+	if not workdir:
+		workdir = os.path.join(output_dir, '.sortdicoms_shards', time.strftime('%Y%m%d_%H%M%S'))
+	os.makedirs(workdir, exist_ok = True)
+
+	with Timed('ShardInputs', input_dir = input_dir, njobs = njobs, by = shard_by) as record:
+		shards = ShardInputs(input_dir, njobs, by = shard_by)
+		record['shards'] = len(shards)
+
+	if not shards:
+		print('No files found in', input_dir)
+		return None
+
+	shardfiles = list()
+	for i, files in enumerate(shards):
+		shardfiles.append(os.path.join(workdir, 'shard_{:04d}.json'.format(i)))
+		with open(shardfiles[-1], 'w') as f:
+			json.dump({'files': files, 'output_dir': output_dir, 'overwrite': overwrite,
+				'manifest': shardfiles[-1].replace('.json', '.manifest.tsv'), 'max_memory': max_memory}, f)
+
+	command = '{} -c "import mrpyconvert; mrpyconvert.SortShard(\'${{x}}\')"'.format(sys.executable)
+	job = slurmpy.SlurmJob(jobname = 'sort', command = command, array = shardfiles, 
+		output_directory = workdir, **slurm_params)
+	job.WriteSlurmFile(filename = os.path.join(workdir, 'sort.srun'))
+	jobid = job.SubmitSlurmFile()
+	if not jobid:
+		return None
+
+	# afterany: merge whatever the shards managed, MergeSortManifests reports the rest
+	command = 'import mrpyconvert\n'
+	command += 'mrpyconvert.MergeSortManifests("{}", "{}")'.format(workdir, output_dir)
+	reduce_job = slurmpy.SlurmJob(jobname = 'sort_reduce', command = command, dependency = jobid, 
+		deptype = 'any', output_directory = workdir, **slurm_params)
+	reduce_job.WriteSlurmFile(filename = os.path.join(workdir, 'reduce.srun'), interpreter = 'python')
+	return reduce_job.SubmitSlurmFile()
+
+# one array task of the distributed sort
+def SortShard(shardfile):
+	with open(shardfile) as f:
+		shard = json.load(f)
+	report = SortDicoms(shard['files'], shard['output_dir'], overwrite = shard['overwrite'], 
+		manifest = shard['manifest'], max_memory = shard.get('max_memory'))
+	# tells the reduce step this shard finished
+	open(shardfile.replace('.json', '.done'), 'w').close()
+	return report
+
+def MergeSortManifests(workdir, output_dir):
+	"""reduce step of the distributed sort: merge the shard manifests in 
+	workdir into the index in output_dir and report duplicates
+
+	Identical copies of one SOPInstanceUID that different shards saved 
+	under different names are removed, keeping the indexed one. Different
+	content for one SOPInstanceUID is reported as a conflict and the later
+	copy is removed, the source is left as it is. The report
+	is also written to workdir/report.json.
+
+	Returns
+	-------
+	dict as SortDicoms, plus 'duplicates' (copies removed) and 
+	'incomplete' (shards that didn't finish)
+	"""
+	with Timed('MergeSortManifests', workdir = workdir, output_dir = output_dir) as record:
+		report = {'copied': [], 'identical': [], 'conflicts': [], 'renamed': [], 'duplicates': []}
+		report['incomplete'] = [x for x in sorted(glob.glob(os.path.join(workdir, 'shard_*.json')))
+			if not os.path.exists(x.replace('.json', '.done'))]
+
+		index = ReadSortIndex(output_dir)
+		rows = list()
+		for manifest in sorted(glob.glob(os.path.join(workdir, 'shard_*.manifest.tsv'))):
+			with open(manifest) as f:
+				for row in csv.reader(f, dialect = 'excel-tab'):
+					if len(row) != 5:
+						continue
+					status, uid, content_hash, relpath, source = row
+					report[status].append(source)
+					if status == 'renamed':
+						report['copied'].append(source)
+					if not uid or not relpath or index.get(uid) == (content_hash, relpath):
+						continue
+
+					if uid in index and status != 'conflicts':
+						if index[uid][0] == content_hash:
+							# another shard has this file under a different name
+							if status in ['copied', 'renamed']:
+								os.remove(os.path.join(output_dir, relpath))
+								report['duplicates'].append(relpath)
+						else:
+							report['conflicts'].append(source)
+							# as SortDicoms, a conflict isn't left where Convert would find it
+							if status in ['copied', 'renamed'] and relpath != index[uid][1]:
+								os.remove(os.path.join(output_dir, relpath))
+								report['copied'].remove(source)
+								if status == 'renamed':
+									report['renamed'].remove(source)
+						continue
+
+					index[uid] = (content_hash, relpath)
+					rows.append([uid, content_hash, relpath])
+
+		if rows:
+			index_file = journal(os.path.join(output_dir, sort_index_name))
+			for row in rows:
+				index_file.write(row)
+			index_file.close()
+
+		# copies killed shards left behind
+		CleanPartials(os.path.join(output_dir, partial_dir_name))
+
+		with open(os.path.join(workdir, 'report.json'), 'w') as f:
+			json.dump(report, f, indent = 1)
+
+		print('{} copied, {} identical skipped, {} conflicting, {} renamed, {} duplicates removed'.format(
+			*[len(report[k]) for k in ['copied', 'identical', 'conflicts', 'renamed', 'duplicates']]))
+		for shard in report['incomplete']:
+			print('Shard did not finish: ', shard)
+
+		for key in report:
+			record[key] = len(report[key])
+		return report
+
+def SortDicoms(input_dir, output_dir, overwrite = False, preview = False, slurm = False, account = None,
+	njobs = None, shard_by = 'dir', workdir = None, manifest = None, max_memory = None, cache = None, 
+	**slurm_params):
+	"""copy dicoms into output_dir/subject_date_time/Series_no_description
+
+	input_dir may contain tar/zip archives of dicoms (or be one, or be a
+	list of files). Headers are read from the archive members directly and
+	only the members that are kept are extracted.
+
+	Files are deduplicated on SOPInstanceUID plus a content hash, kept in
+	an index in output_dir, so re-sorting overlapping exports copies 
+	nothing twice whatever the file names. A file with a known UID but 
+	different content is a conflict and is only copied if overwrite. A
+	new file whose name is taken by a different file is saved under the
+	name with its hash appended.
+
+	slurm submits the sort as a slurm job. With njobs as well, the sort 
+	is distributed over a job array of njobs shards of the input, split
+	by directory or by file count (shard_by 'dir' or 'files'), and a 
+	reduce job merges the shard manifests; see SubmitShardedSort.
+
+	manifest: record every file in this file instead of the index in
+	output_dir, and place files without clobbering, so concurrent shards
+	can share output_dir. Used by the shard jobs.
+
+	max_memory: bytes of any one dicom held in memory (default 
+	sort_memory_limit), headers are read without pixel data or other big
+	elements and copies are streamed. For slurm jobs, mem defaults to 
+	twice max_memory, or max_memory to half of mem if that's given.
+
+	cache: a dict kept between calls that sort into the same output_dir, 
+	which then holds the index and journal in memory instead of reading 
+	them again each call (they're reread if another process added to 
+	them). Used by Ingest.
+
+	Returns
+	-------
+	dict with lists of 'copied', 'identical' (skipped, already sorted), 
+	'conflicts', 'renamed' and 'resumed' (skipped unread, an earlier run 
+	sorted them) files, or a jobid if slurm
+	"""
+
+	if account:
+		slurm_params['account'] = account
+
+	if slurm:
+		# the other half is for python, pydicom and the index
+		if max_memory and 'mem' not in slurm_params:
+			slurm_params['mem'] = '{}M'.format(2 * max_memory // 1024 ** 2)
+		elif not max_memory and 'mem' in slurm_params:
+			import slurmpy
+			# megabytes to bytes
+			max_memory = int(slurmpy.ParseMemory(slurm_params['mem']) * 1024 ** 2) // 2
 
+	if slurm and njobs and not preview:
+		return SubmitShardedSort(input_dir, output_dir, njobs, shard_by = shard_by, workdir = workdir, 
+			overwrite = overwrite, max_memory = max_memory, **slurm_params)
 
-	if duplicates:
-		print('One or more files already existing and not moved')
+	if slurm:
+		command = 'import mrpyconvert\n'
+		command += 'mrpyconvert.SortDicoms("{}","{}", overwrite = {}, preview = {}, slurm = False, max_memory = {})'.format(
+			input_dir, output_dir, overwrite, preview, max_memory)
 
+		import slurmpy
+		filename = tempfile.NamedTemporaryFile().name
+		job = slurmpy.SlurmJob(jobname = 'sort', command = command, **slurm_params)
+		job.WriteSlurmFile(filename = filename, interpreter = 'python')
+		return job.SubmitSlurmFile()
 
+	with Timed('SortDicoms', input_dir = input_dir if isinstance(input_dir, str) else manifest, 
+		output_dir = output_dir) as record:
+		report = {'copied': [], 'identical': [], 'conflicts': [], 'renamed': [], 'resumed': []}
+		index_file = None
+
+		# checkpoint: every source dealt with, so a rerun skips them unread
+		journal_file = manifest + '.journal' if manifest else os.path.join(output_dir, sort_journal_name)
+		state_files = [os.path.join(output_dir, sort_index_name), journal_file]
+		if cache is not None and (preview or overwrite or manifest):
+			cache = None
+		if cache is not None and cache.get('sizes') == FileSizes(state_files):
+			index, done = cache['index'], cache['done']
+		else:
+			index = ReadSortIndex(output_dir)
+			done = dict()
+			if not preview and not overwrite:
+				done = ReadSortJournal(journal_file)
+		sources = None
+
+		def finished(file, version, status, relpath = '', size = ''):
+			sources.write([file, version, status, relpath, size])
+			done[file] = (version, relpath, str(size))
+
+		def skip(file, version):
+			if SortJournalDone(done.get(file), version, output_dir):
+				report['resumed'].append(file)
+				return True
+			return False
+
+		partial_dir = os.path.join(output_dir, partial_dir_name)
+		if not preview:
+			CleanPartials(partial_dir)
+
+		# keep the index up to date, and the manifest if there is one
+		def remember(uid, content_hash, newname, file, status):
+			nonlocal index_file
+			row = None
+			if uid and newname:
+				entry = (content_hash, os.path.relpath(newname, output_dir))
+				if index.get(uid) != entry:
+					index[uid] = entry
+					row = [uid, content_hash, entry[1]]
+			if manifest:
+				row = [status, uid, content_hash, os.path.relpath(newname, output_dir) if newname else '', file]
+			if not row:
+				return
+			if not index_file:
+				index_file = journal(manifest if manifest else os.path.join(output_dir, sort_index_name))
+			index_file.write(row)
+
+		# listing and header reads happen inside the generator
+		for file, version, name, ds, copy, digest in TimedIter(ReadDicoms(input_dir, max_memory = max_memory, 
+			skip = skip), record, 'read'):
+			record['files'] = record.get('files', 0) + 1
+
+			newname = SortedName(ds, output_dir, name)
+
+			if preview:
+				print(file, '-->', newname)
+				continue
+
+			if not sources:
+				# a source must never be marked done before it's indexed
+				sources = journal(journal_file, before = lambda: index_file and index_file.sync())
+
+			uid = str(ds.get('SOPInstanceUID', ''))
+			content_hash = None
+			# needed first only to compare with a file that's there, 
+			# otherwise it's taken while copying
+			if uid in index or os.path.exists(newname):
+				with Accumulate(record, 'hash'):
+					content_hash = digest()
+
+			status = 'copied'
+			placed = None
+			if uid in index:
+				known_hash, known_name = index[uid]
+				if known_hash == content_hash:
+					report['identical'].append(file)
+					remember(uid, content_hash, os.path.join(output_dir, known_name), file, 'identical')
+					finished(file, version, 'identical')
+					continue
+				report['conflicts'].append(file)
+				if not overwrite:
+					remember(uid, content_hash, None, file, 'conflicts')
+					finished(file, version, 'conflicts')
+					continue
+				newname = os.path.join(output_dir, known_name)
+				status = 'conflicts'
+
+			elif os.path.exists(newname) and not overwrite:
+				# sorted before the index existed, or a different file with the same name
+				if HashFile(newname) == content_hash:
+					report['identical'].append(file)
+					remember(uid, content_hash, newname, file, 'identical')
+					finished(file, version, 'identical')
+					continue
+				root, ext = os.path.splitext(newname)
+				newname = '{}_{}{}'.format(root, content_hash[:8], ext)
+				report['renamed'].append(file)
+				status = 'renamed'
+
+			with Accumulate(record, 'copy'):
+				os.makedirs(os.path.dirname(newname), exist_ok = True)
+				if manifest and not overwrite:
+					placed, content_hash = PlaceFile(copy, newname, partial_dir)
+				else:
+					# copied aside and renamed, so a killed copy never looks sorted
+					partial = PartialName(partial_dir)
+					content_hash = copy(partial)
+					os.replace(partial, newname)
+					placed = newname
+
+			if not placed:
+				# another shard got there first with the same file
+				report['identical'].append(file)
+				remember(uid, content_hash, newname, file, 'identical')
+				finished(file, version, 'identical')
+				continue
+			if placed != newname and status == 'copied':
+				report['renamed'].append(file)
+				status = 'renamed'
+			report['copied'].append(file)
+			remember(uid, content_hash, placed, file, status)
+			finished(file, version, status, os.path.relpath(placed, output_dir), os.path.getsize(placed))
+
+		if sources:
+			sources.close()
+		if index_file:
+			index_file.close()
+		if cache is not None:
+			cache.update(index = index, done = done, sizes = FileSizes(state_files))
+
+		if not preview:
+			print('{} copied, {} identical skipped, {} conflicting, {} renamed, {} already sorted'.format(
+				*[len(report[k]) for k in ['copied', 'identical', 'conflicts', 'renamed', 'resumed']]))
+			for file in report['conflicts']:
+				print('Conflicting content for existing SOPInstanceUID: ', file)
+
+		for key in report:
+			record[key] = len(report[key])
+		return report
+
+
+# watch folder ingest
+
+def WatchFiles(incoming, poll = 30, settle = 2):
+	"""yields lists of files under incoming as they finish being written
+
+	Uses inotifywait (inotify-tools) when it's installed; everything in
+	incoming is yielded first, then events are collected until none 
+	arrive for settle seconds. Otherwise incoming is
+	polled every poll seconds, and a file is finished once its size and 
+	mtime didn't change between two polls. Either way an empty list is 
+	yielded at least every poll seconds so the caller can check the clock.
+	"""
+	if shutil.which('inotifywait'):
+		import select
+		proc = subprocess.Popen(['inotifywait', '-m', '-r', '-q', '-e', 'close_write', 
+			'-e', 'moved_to', '--format', '%w%f', incoming], stdout = subprocess.PIPE)
+		fd = proc.stdout.fileno()
+		pending = b''
+		try:
+			# whatever arrived while nothing was watching; files also 
+			# reported by events are skipped by SortDicoms
+			yield ListFiles(incoming)
+			while True:
+				batch = list()
+				timeout = poll
+				# a steady stream of events still yields every poll seconds
+				deadline = time.time() + poll
+				while timeout > 0 and select.select([fd], [], [], timeout)[0]:
+					chunk = os.read(fd, 65536)
+					if not chunk:
+						raise RuntimeError('inotifywait exited with {}'.format(proc.wait()))
+					lines = (pending + chunk).split(b'\n')
+					pending = lines.pop()
+					for line in lines:
+						path = os.fsdecode(line)
+						# a directory moved in doesn't report its contents
+						batch += ListFiles(path) if os.path.isdir(path) else [path]
+					timeout = min(settle, deadline - time.time())
+				yield batch
+		finally:
+			proc.terminate()
+
+	seen = dict()
+	done = set()
+	while True:
+		current = dict()
+		for file in ListFiles(incoming):
+			try:
+				st = os.stat(file)
+			except OSError:
+				continue
+			current[file] = (st.st_size, st.st_mtime)
+		batch = [f for f in current if f not in done and seen.get(f) == current[f]]
+		done = set(f for f in done if f in current).union(batch)
+		seen = current
+		yield batch
+		time.sleep(poll)
+
+ingest_state_name = '.ingest_state.json'
+
+def Ingest(incoming, dicomdir, bidsdir, bids_dict, quiet = 600, expected_series = None, 
+	poll = 30, slurm = False, once = False, **convert_params):
+	"""watch incoming for new dicoms, sort them into dicomdir and convert
+	each session to bidsdir as soon as it's complete
+
+	New files are sorted as they arrive (see WatchFiles, SortDicoms skips
+	anything already sorted). A session (subject directory in dicomdir) is
+	complete when no files have arrived for it for quiet seconds, or once
+	it has expected_series series directories and no files arrived in the
+	last poll. Each complete session is converted on its own with Convert,
+	locally or through slurm; convert_params go to Convert. A session that
+	gets more files after it was converted is converted again.
+
+	Converted sessions are kept in dicomdir/.ingest_state.json, so a 
+	restarted watcher picks up where it stopped. once sorts what's in 
+	incoming now, converts the sessions that are complete (judged by 
+	their newest sorted file's mtime, so a session sorted now converts on
+	a later run) and returns, e.g. for cron. 
+	Otherwise runs until interrupted.
+
+	Returns
+	-------
+	dict of session -> {'ndicoms', 'time', 'result' or 'error'}
+	"""
+	state_file = os.path.join(dicomdir, ingest_state_name)
+	state = dict()
+	if os.path.exists(state_file):
+		with open(state_file) as f:
+			state = json.load(f)
+
+	# session -> (number of dicoms, when that number was first seen)
+	activity = dict()
+
+	def check_sessions():
+		if not os.path.isdir(dicomdir):
+			return
+		catalog = ScanDicomDir(dicomdir)
+		now = time.time()
+		for subjectdir in sorted(catalog):
+			series = catalog[subjectdir]
+			ndicoms = sum(s['ndicoms'] for s in series.values())
+			if subjectdir in state and state[subjectdir]['ndicoms'] == ndicoms:
+				continue
+			if once:
+				# nobody watched the session arrive, go by its newest file
+				mtimes = [os.path.getmtime(f) for f in ListFiles(subjectdir)]
+				activity[subjectdir] = (ndicoms, max(mtimes, default = now))
+			elif subjectdir not in activity or activity[subjectdir][0] != ndicoms:
+				activity[subjectdir] = (ndicoms, now)
+			idle = now - activity[subjectdir][1]
+			if not (idle >= quiet or 
+				(expected_series and len(series) >= expected_series and idle >= min(poll, quiet))):
+				continue
+
+			params = dict(convert_params)
+			if params.get('capture', True) and not params.get('logdir'):
+				params['logdir'] = os.path.join(bidsdir, 'code', 'mrpyconvert', 'logs', 
+					'{}_{}'.format(time.strftime('%Y%m%d-%H%M%S'), os.path.basename(subjectdir)))
+			entry = {'ndicoms': ndicoms, 'time': time.strftime('%Y-%m-%d %H:%M:%S')}
+			print('Converting', subjectdir)
+			try:
+				with Timed('Ingest', session = subjectdir, ndicoms = ndicoms):
+					result = Convert(subjectdir, bidsdir, bids_dict, slurm = slurm, **params)
+				entry['result'] = result if slurm else params.get('logdir')
+			except Exception as e:
+				# keep watching, the session is retried when more files arrive
+				print('Conversion of {} failed: {}'.format(subjectdir, e))
+				entry['error'] = str(e)
+			state[subjectdir] = entry
+			del activity[subjectdir]
+
+			os.makedirs(dicomdir, exist_ok = True)
+			with open(state_file + '.tmp', 'w') as f:
+				json.dump(state, f, indent = 1)
+			os.replace(state_file + '.tmp', state_file)
+
+	# index and journal of dicomdir, kept between batches
+	sort_cache = dict()
+
+	if once:
+		batches = [ListFiles(incoming)]
+	else:
+		batches = WatchFiles(incoming, poll = poll)
+
+	try:
+		for batch in batches:
+			if batch:
+				SortDicoms(batch, dicomdir, cache = sort_cache)
+			check_sessions()
+	except KeyboardInterrupt:
+		pass
+
+	return state
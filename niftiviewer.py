@@ -1,22 +1,117 @@
 # useful routines for visually inspecting nifti files in a jupyter notebook
 
 import numpy as np
-import matplotlib
-import matplotlib.pyplot as plt
-import nibabel as nib
 import math
+import functools
 from time import sleep
-from IPython.display import clear_output
-import tempfile
 import subprocess
 import os
 
+# matplotlib, nibabel and IPython are imported where they are used, they
+# are slow to import and most helpers here don't need all of them
+
 # todo: 
 # need to test with rgb data
-# add overlay cmap parameter
+
+# windowing: display range is worked out once per volume from a strided
+# sample and every slice/frame goes through the same uint8 lookup table,
+# so contrast is consistent and imshow never has to autoscale
+
+def WindowLevels(data, percentiles = (1, 99), nsamples = 100000, nonzero = False,
+                 volno = 0):
+    """
+    Robust display range for a volume
+
+    Parameters
+    ----------
+    data: numpy array or image proxy
+    percentiles: (low, high)
+    nsamples: int
+        approximate number of voxels to sample. Sampling is strided on
+        every axis, so proxies only read the sampled voxels.
+    nonzero: bool
+        ignore zero voxels, for overlays where zero is transparent
+    volno: int
+        volume to sample if data is 4d
+
+    Returns
+    -------
+    (vmin, vmax)
+    """
+    shape = np.array(data.shape[:3])
+    step = max(1, int((np.prod(shape) / nsamples) ** (1 / len(shape))))
+    slicer = (slice(None, None, step),) * len(shape)
+    if len(data.shape) > 3:
+        slicer += (volno,)
+    sample = np.asarray(data[slicer], dtype = np.float32).ravel()
+    sample = sample[np.isfinite(sample)]
+    if nonzero:
+        sample = sample[sample != 0]
+    if sample.size == 0:
+        return 0.0, 1.0
+    # np.percentile uses a partial sort (introselect), not a full sort
+    vmin, vmax = np.percentile(sample, percentiles)
+    if vmax <= vmin:
+        vmin, vmax = sample.min(), sample.max()
+    return float(vmin), float(vmax)
+
+
+@functools.lru_cache(maxsize = None)
+def ColormapLUT(cmap = 'gray', alpha = False):
+    """
+    256 entry uint8 rgb (or rgba) lookup table for a matplotlib colormap
+
+    Built once per (cmap, alpha) and shared, so it's read only
+    """
+    import matplotlib
+
+    lut = matplotlib.colormaps[cmap](np.linspace(0, 1, 256))
+    if not alpha:
+        lut = lut[:, :3]
+    lut = np.round(lut * 255).astype(np.uint8)
+    lut.flags.writeable = False
+    return lut
+
+
+def ApplyWindow(data, window, cmap = 'gray', transparent = False):
+    """
+    Map data through a display window and colormap in one vectorized pass
+
+    Parameters
+    ----------
+    data: numpy array, any shape
+    window: (vmin, vmax)
+    cmap: str
+        matplotlib colormap name
+    transparent: bool
+        return rgba with zero voxels fully transparent
+
+    Returns
+    -------
+    uint8 numpy array, data.shape + (3,) or (4,) if transparent
+    """
+    vmin, vmax = window
+    data = np.asarray(data, dtype = np.float32)
+    scale = 255 / (vmax - vmin) if vmax > vmin else 0
+    index = np.clip((data - vmin) * scale, 0, 255)
+    index = np.nan_to_num(index).astype(np.uint8)
+    rgb = ColormapLUT(cmap, alpha = transparent)[index]
+    if transparent:
+        rgb[..., 3][data == 0] = 0
+    return rgb
+
+
+def GetSlice(data, slice_number, view_axis):
+    """
+    Read a single slice, only touching that slice if data is a proxy
+    """
+    slicer = [slice(None)] * len(data.shape)
+    slicer[view_axis] = slice_number
+    return np.asarray(data[tuple(slicer)])
+
 
 def SliceView(data3d, plot_axis, view_axis, slice_number, 
-    transparent = False, **kwargs):
+    transparent = False, window = None, cmap = 'gray', **kwargs):
     """
     Parameters
     ----------
@@ -24,39 +119,265 @@ def SliceView(data3d, plot_axis, view_axis, slice_number,
     plot_axis: matplotlib axis
     view_axis: int
     slice_number: int
+    window: (vmin, vmax), optional
+        display range, from WindowLevels(data3d) if not given
+    cmap: str
+        matplotlib colormap name, None to show rgb data as is
     """
-    # thought I'd tested this and it worked? not working with pineapple_vibe.nii
- #   plot_axis.imshow(np.rot90(data3d.take(indices=slice_number, axis=view_axis)), **kwargs)
-    plot_data = np.array(data3d).take(indices=slice_number, axis=view_axis)
-    if transparent:
-        plot_data = np.ma.masked_where(plot_data == 0, plot_data)
+    plot_data = GetSlice(data3d, slice_number, view_axis)
+
+    if cmap is None:
+        plot_axis.imshow(np.rot90(plot_data), **kwargs)
+        plot_axis.axis('off')
+        return
+
+    if window is None:
+        if 'vmin' in kwargs and 'vmax' in kwargs:
+            window = (kwargs['vmin'], kwargs['vmax'])
+        else:
+            window = WindowLevels(data3d)
+    kwargs.pop('vmin', None)
+    kwargs.pop('vmax', None)
 
-    plot_axis.imshow(np.rot90(plot_data), **kwargs)
+    ShowSlice(plot_data, plot_axis, window, cmap = cmap,
+              transparent = transparent, **kwargs)
+
+
+def ShowSlice(plot_data, plot_axis, window, cmap = 'gray', transparent = False,
+              **kwargs):
+    """
+    Draw an already extracted 2d slice through a display window
+    """
+    rgb = ApplyWindow(plot_data, window, cmap = cmap, transparent = transparent)
+    plot_axis.imshow(np.rot90(rgb), **kwargs)
     plot_axis.axis('off')
 
 
-# how to do overlays?
+# thumbnail pyramid: a .npz sidecar next to the nifti file holding the
+# display window, the three orthogonal middle slices and block-averaged
+# copies of the volume. Rebuilt whenever the nifti file's mtime changes.
+
+pyramid_factors = (2, 4, 8)
+
+def PyramidPath(niftipath):
+    return str(niftipath) + '.pyramid.npz'
+
+
+def Downsample(data, factor):
+    """
+    Block-average a 3d array by an integer factor on every axis
+    """
+    data = np.asarray(data, dtype = np.float32)
+    pad = [(0, -n % factor) for n in data.shape]
+    data = np.pad(data, pad, mode = 'edge')
+    nx, ny, nz = [n // factor for n in data.shape]
+    return data.reshape(nx, factor, ny, factor, nz, factor).mean(axis = (1, 3, 5))
+
+
+def BuildPyramid(niftipath, volno = 0, factors = pyramid_factors):
+    """
+    Compute the thumbnail pyramid for a nifti file and save the sidecar
+
+    The sidecar is skipped quietly if the directory isn't writable.
+
+    Returns
+    -------
+    dict of pyramid arrays
+    """
+    import nibabel as nib
+
+    img = nib.load(str(niftipath))
+    if len(img.shape) > 3:
+        data = np.asarray(img.dataobj[..., volno], dtype = np.float32)
+    else:
+        data = np.asarray(img.dataobj, dtype = np.float32)
+
+    pyramid = {'mtime': os.stat(str(niftipath)).st_mtime, 'volno': volno,
+               'shape': np.array(data.shape),
+               'window': np.array(WindowLevels(data))}
+    for axis in range(3):
+        pyramid['middle{}'.format(axis)] = data.take(data.shape[axis] // 2, axis = axis)
+    for factor in factors:
+        pyramid['level{}'.format(factor)] = Downsample(data, factor)
+
+    try:
+        with open(PyramidPath(niftipath), 'wb') as f:
+            np.savez_compressed(f, **pyramid)
+    except OSError:
+        pass
+
+    return pyramid
+
+
+def LoadPyramid(niftipath, volno = 0):
+    """
+    Thumbnail pyramid for a nifti file, from the sidecar if it is current
+
+    Returns
+    -------
+    dict of pyramid arrays: 'window', 'shape', 'middle0'..'middle2',
+    'level2', 'level4', 'level8'
+    """
+    path = PyramidPath(niftipath)
+    if os.path.exists(path):
+        try:
+            with np.load(path) as f:
+                pyramid = dict(f)
+            if (pyramid['mtime'] == os.stat(str(niftipath)).st_mtime
+                    and pyramid['volno'] == volno):
+                return pyramid
+        except (OSError, ValueError, KeyError):
+            pass
+    return BuildPyramid(niftipath, volno = volno)
+
+
+def PyramidFactor(mag, factors = pyramid_factors):
+    """
+    Coarsest pyramid level that still has at least mag screen pixels
+    per voxel, None if full resolution is needed
+    """
+    usable = [f for f in factors if f * mag <= 1]
+    return max(usable) if usable else None
+
+
+# overlays: the displayed base slice is mapped through both affines into
+# overlay voxel space and only the overlay voxels under that slice are
+# read and interpolated. Sample positions are cached per geometry pair.
+
+overlay_cache = dict()
+
+def OverlayCoordinates(base_img, overlay_img, view_axis, slice_number):
+    """
+    Overlay voxel coordinates (3, nx, ny) for every pixel of a base slice
+    """
+    key = (base_img.affine.tobytes(), overlay_img.affine.tobytes(),
+           tuple(base_img.shape[:3]), view_axis, int(slice_number))
+    if key in overlay_cache:
+        return overlay_cache[key]
+
+    shape = list(base_img.shape[:3])
+    shape[view_axis] = 1
+    ijk = np.indices(shape, dtype = np.float64).reshape(3, -1)
+    ijk[view_axis] = slice_number
+
+    # base voxel -> world -> overlay voxel in one matrix
+    transform = np.linalg.inv(overlay_img.affine).dot(base_img.affine)
+    coords = transform[:3, :3].dot(ijk) + transform[:3, 3:]
+    coords = coords.reshape([3] + [n for i, n in enumerate(shape) if i != view_axis])
+
+    if len(overlay_cache) > 256:
+        overlay_cache.clear()
+    overlay_cache[key] = coords
+    return coords
+
+
+def OverlaySlice(base_img, overlay_img, view_axis, slice_number, volno = 0,
+                 order = 0):
+    """
+    Overlay resampled onto one slice of the base image grid
+
+    Parameters
+    ----------
+    base_img, overlay_img: nibabel images
+    view_axis: int
+    slice_number: int
+        slice in base voxel coordinates
+    volno: int
+        overlay volume if overlay is 4d
+    order: int
+        0 for nearest neighbour (masks, labels), 1 for trilinear
+
+    Returns
+    -------
+    2d numpy array on the base slice grid, 0 outside the overlay
+    """
+    overlay_shape = np.array(overlay_img.shape[:3])
+
+    if (np.allclose(base_img.affine, overlay_img.affine)
+            and tuple(overlay_shape) == tuple(base_img.shape[:3])):
+        slicer = [slice(None)] * 3
+        slicer[view_axis] = slice_number
+        if len(overlay_img.shape) > 3:
+            slicer.append(volno)
+        return np.asarray(overlay_img.dataobj[tuple(slicer)])
+
+    coords = OverlayCoordinates(base_img, overlay_img, view_axis, slice_number)
+    if order == 0:
+        coords = np.round(coords)
+    low = np.floor(coords).astype(int)
+    last = overlay_shape[:, None, None] - 1
+
+    result = np.zeros(coords.shape[1:], dtype = np.float32)
+    inside = np.all((low >= 0) & (low <= last), axis = 0)
+    if not inside.any():
+        return result
+    # on the last plane the upper neighbour gets no weight, clamp it
+    high = np.minimum(low + (1 if order else 0), last)
+
+    # read only the bounding box of overlay voxels under this slice
+    start = np.array([low[i][inside].min() for i in range(3)])
+    stop = np.array([high[i][inside].max() for i in range(3)]) + 1
+    slicer = tuple(slice(a, b) for a, b in zip(start, stop))
+    if len(overlay_img.shape) > 3:
+        slicer += (volno,)
+    block = np.asarray(overlay_img.dataobj[slicer], dtype = np.float32)
+
+    index = low[:, inside] - start[:, None]
+    if order == 0:
+        result[inside] = block[tuple(index)]
+        return result
+
+    high_index = high[:, inside] - start[:, None]
+    frac = (coords[:, inside] - low[:, inside]).astype(np.float32)
+    values = np.zeros(index.shape[1], dtype = np.float32)
+    for corner in np.ndindex(2, 2, 2):
+        weight = np.ones(index.shape[1], dtype = np.float32)
+        for i, c in enumerate(corner):
+            weight *= frac[i] if c else 1 - frac[i]
+        values += weight * block[tuple(high_index[i] if c else index[i] 
+                                       for i, c in enumerate(corner))]
+    result[inside] = values
+    return result
+
+
 def QuickView(niftipath, plot_array = [1,1], volno = 0, view_axis = 2, mag = 1, 
     crop = 0, slices = None, outfile = None, cmap = 'gray', overlay = None, 
-    **kwargs):
+    overlay_cmap = 'viridis', percentiles = (1, 99), cache = True,
+    overlay_order = 0, **kwargs):
+    import matplotlib.pyplot as plt
+    import nibabel as nib
 
     if slices and plot_array[0]*plot_array[1] != len(slices):
         plot_array[0] = 1
         plot_array[1] = len(slices)
 
     img = nib.load(str(niftipath))
-    if len(img.shape) > 3:
-        data = img.dataobj[:,:,:,volno]
+    full_shape = np.array(img.shape[:3])
+
+    # small stamps come from the thumbnail pyramid, no full read
+    factor = None
+    if cache and not overlay and percentiles == (1, 99):
+        factor = PyramidFactor(mag)
+
+    if factor:
+        pyramid = LoadPyramid(niftipath, volno = volno)
+        data = pyramid['level{}'.format(factor)]
+        window = tuple(pyramid['window'])
+        if slices:
+            slices = [z // factor for z in slices]
     else:
-        data = img.dataobj
+        if len(img.shape) > 3:
+            data = img.dataobj[:,:,:,volno]
+        else:
+            data = img.dataobj
+        window = WindowLevels(data, percentiles)
 
-    # todo: check if dimensions are consistent
+    # overlay is resampled slice by slice onto the base grid
     if overlay:
         overlay_img = nib.load(str(overlay))
-        if len(img.shape) > 3:
-            overlay_data = overlay_img.dataobj[:,:,:,volno]
-        else:
-            overlay_data = overlay_img.dataobj
+        overlay_volno = volno if len(overlay_img.shape) > 3 else 0
+        overlay_window = WindowLevels(overlay_img.dataobj, percentiles,
+                                      nonzero = True, volno = overlay_volno)
 
     zooms = np.delete(img.header.get_zooms()[0:3], view_axis)
     aspect = zooms[1] / zooms[0]
@@ -65,7 +386,7 @@ def QuickView(niftipath, plot_array = [1,1], volno = 0, view_axis = 2, mag = 1,
     nrows = plot_array[0]
     ncols = plot_array[1]
     dpi = 72
-    stampsize = np.array(data.shape)*mag/dpi
+    stampsize = full_shape*mag/dpi
     plt.figure(figsize=(stampsize[0]* ncols, stampsize[1]*nrows), dpi = dpi)
 
     nslices = nrows * ncols
@@ -73,38 +394,50 @@ def QuickView(niftipath, plot_array = [1,1], volno = 0, view_axis = 2, mag = 1,
     if not slices:
         step = int(data.shape[view_axis]*(100-crop)/(100*(nslices+1)))
         start = step + int(0.5*data.shape[view_axis]*crop/100)
-        slices = range(start, data.shape[view_axis] + 1 - step, step)
+        slices = range(start, data.shape[view_axis] + 1 - step, max(step, 1))
 
 
 
     for i,z in enumerate(slices[:nslices]):
         axis = plt.subplot(nrows, ncols, i+1)
-        SliceView(data, plot_axis = axis, slice_number = z,
+        SliceView(data, plot_axis = axis, slice_number = z, window = window,
                   view_axis = view_axis, aspect = aspect, cmap = cmap, **kwargs)
         if overlay:
-            SliceView(overlay_data, plot_axis = axis, slice_number = z,
-                      view_axis = view_axis, aspect = aspect, transparent = True,
-                      **kwargs)
+            overlay_slice = OverlaySlice(img, overlay_img, view_axis, z,
+                                         volno = overlay_volno, order = overlay_order)
+            ShowSlice(overlay_slice, axis, overlay_window, cmap = overlay_cmap,
+                      transparent = True, aspect = aspect, **kwargs)
 
     plt.tight_layout()
     if outfile:
         plt.savefig(outfile, bbox_inches = 'tight')
     plt.show()
 
-def Orthoview(niftipath, slices=[0,0,0], volno = 0, overlay = None, cmap = 'gray', **kwargs):
+def Orthoview(niftipath, slices=[0,0,0], volno = 0, overlay = None, cmap = 'gray',
+              overlay_cmap = 'viridis', percentiles = (1, 99), cache = True,
+              overlay_order = 0, **kwargs):
+    import matplotlib.pyplot as plt
+    import nibabel as nib
 
     img = nib.load(str(niftipath))
-    if len(img.shape) > 3:
-        data = img.dataobj[:,:,:,volno]
+
+    # the default middle slices are stored in the thumbnail pyramid
+    pyramid = None
+    if cache and not np.any(slices) and percentiles == (1, 99):
+        pyramid = LoadPyramid(niftipath, volno = volno)
+        window = tuple(pyramid['window'])
     else:
-        data = img.dataobj
+        if len(img.shape) > 3:
+            data = img.dataobj[:,:,:,volno]
+        else:
+            data = img.dataobj
+        window = WindowLevels(data, percentiles)
 
     if overlay:
         overlay_img = nib.load(str(overlay))
-        if len(img.shape) > 3:
-            overlay_data = overlay_img.dataobj[:,:,:,volno]
-        else:
-            overlay_data = overlay_img.dataobj
+        overlay_volno = volno if len(overlay_img.shape) > 3 else 0
+        overlay_window = WindowLevels(overlay_img.dataobj, percentiles,
+                                      nonzero = True, volno = overlay_volno)
 
     slice_indices = slices + np.array(img.shape[:3]) // 2
 
@@ -116,11 +449,17 @@ def Orthoview(niftipath, slices=[0,0,0], volno = 0, overlay = None, cmap = 'gray
     fig, axes = plt.subplots(1, 3, figsize=(30, 10))
 
     for i, ax in enumerate(axes):
-        SliceView(data, plot_axis= ax, slice_number=slice_indices[i],
-                  view_axis=i, aspect=aspect[i], cmap = cmap, **kwargs)
+        if pyramid:
+            ShowSlice(pyramid['middle{}'.format(i)], ax, window, cmap = cmap,
+                      aspect = aspect[i], **kwargs)
+        else:
+            SliceView(data, plot_axis= ax, slice_number=slice_indices[i], window = window,
+                      view_axis=i, aspect=aspect[i], cmap = cmap, **kwargs)
         if overlay:
-            SliceView(overlay_data, plot_axis= ax, slice_number=slice_indices[i],
-                  view_axis=i, aspect=aspect[i], transparent = True, **kwargs)
+            overlay_slice = OverlaySlice(img, overlay_img, i, slice_indices[i],
+                                         volno = overlay_volno, order = overlay_order)
+            ShowSlice(overlay_slice, ax, overlay_window, cmap = overlay_cmap,
+                      transparent = True, aspect = aspect[i], **kwargs)
 
     plt.show()
 
@@ -128,6 +467,8 @@ def Orthoview(niftipath, slices=[0,0,0], volno = 0, overlay = None, cmap = 'gray
 # the indices are VOLUME indices
 def ViewByIndices(niftipath, indices, ncols = None, sliceno = None,
                   cmap = 'gray', view_axis = 2, mag = 1, **kwargs):
+    import matplotlib.pyplot as plt
+    import nibabel as nib
 
     img = nib.load(str(niftipath))
     data = img.dataobj
@@ -143,43 +484,303 @@ def ViewByIndices(niftipath, indices, ncols = None, sliceno = None,
     stampsize = np.array(data.shape)*mag/dpi
     plt.figure(figsize=(stampsize[0]* ncols, stampsize[1]*nrows), dpi = dpi)
 
+    window = WindowLevels(data[..., indices[0]])
+
     for i,v in enumerate(indices):
         ax = plt.subplot(nrows, ncols, i+1)
         SliceView(data[...,v], plot_axis=ax, slice_number=sliceno, cmap = cmap,
-                  view_axis=view_axis, **kwargs)
+                  view_axis=view_axis, window = window, **kwargs)
     plt.show()
 
-## EVERYTHING BELOW THIS NEEDS FIXING STILL
+# timeseries summaries for 4d data. The file is streamed in chunks of
+# volumes so memory use is bounded by chunk size, not by run length
+
+def TimeseriesSummary(niftipath, mask = None, chunk = 16, max_voxels = 5000):
+    """
+    Global signal, framewise intensity change and carpet data for a 4d file
 
-# loop through like a movie DOES NOT WORK RIGHT NOW
-def Loop(niftipath, sliceno = None, view_axis = 2, outfile = None):
+    Parameters
+    ----------
+    niftipath: path to 4d nifti file
+    mask: path to nifti file or boolean array, optional
+        voxels to include, nonzero voxels of the first volume if not given
+    chunk: int
+        number of volumes read at a time
+    max_voxels: int
+        carpet rows are an evenly spaced subsample of at most this many
+        mask voxels
+
+    Returns
+    -------
+    dict with
+        'global': mean in-mask signal per volume
+        'framewise': rms in-mask intensity change from the previous volume
+            (DVARS), 0 for the first volume
+        'carpet': (voxels, volumes) array of the subsampled voxels
+    """
+    import nibabel as nib
 
-    img = nib.load(str(niftipath))
+    # one handle for every chunk, otherwise each slice of a .nii.gz
+    # reopens it and decompresses from the start again
+    img = nib.load(str(niftipath), keep_file_open = True)
     data = img.dataobj
+    nvols = data.shape[-1]
 
-    if not sliceno:
-        sliceno = int(data.shape[view_axis]/2)
+    if mask is None:
+        mask = np.asarray(data[..., 0]) != 0
+    elif type(mask) is str:
+        mask = np.asarray(nib.load(mask, keep_file_open = True).dataobj) != 0
+    else:
+        mask = np.asarray(mask) != 0
+
+    voxels = np.flatnonzero(mask)
+    nmask = max(len(voxels), 1)
+    step = max(1, int(np.ceil(len(voxels) / max_voxels)))
+    # positions of the carpet voxels within the masked voxel list
+    carpet_rows = np.arange(0, len(voxels), step)
+
+    global_signal = np.zeros(nvols)
+    framewise = np.zeros(nvols)
+    carpet = np.zeros((len(carpet_rows), nvols), dtype = np.float32)
+    previous = None
+
+    for start in range(0, nvols, chunk):
+        stop = min(start + chunk, nvols)
+        block = np.asarray(data[..., start:stop], dtype = np.float32)
+        block = block.reshape(-1, stop - start)[voxels]
+
+        global_signal[start:stop] = block.sum(axis = 0) / nmask
+        carpet[:, start:stop] = block[carpet_rows]
+
+        if previous is not None:
+            block = np.concatenate([previous, block], axis = 1)
+            framewise[start:stop] = np.sqrt(np.mean(np.diff(block, axis = 1)**2, axis = 0))
+        elif stop - start > 1:
+            framewise[start + 1:stop] = np.sqrt(np.mean(np.diff(block, axis = 1)**2, axis = 0))
+        previous = block[:, -1:]
+
+    return {'global': global_signal, 'framewise': framewise, 'carpet': carpet}
+
+
+def CarpetPlot(niftipath, mask = None, chunk = 16, max_voxels = 5000,
+               cmap = 'gray', outfile = None):
+    """
+    Plot global signal, framewise intensity change and a carpet plot
+    (voxels x time, each voxel z-scored) for a 4d file
 
+    Parameters
+    ----------
+    niftipath: path to 4d nifti file
+    mask, chunk, max_voxels:
+        see TimeseriesSummary
+    cmap: str
+        colormap for the carpet
+    outfile: str, optional
+        save figure to this file
+    """
+    import matplotlib.pyplot as plt
+
+    summary = TimeseriesSummary(niftipath, mask = mask, chunk = chunk,
+                                max_voxels = max_voxels)
+
+    carpet = summary['carpet']
+    std = carpet.std(axis = 1, keepdims = True)
+    std[std == 0] = 1
+    carpet = (carpet - carpet.mean(axis = 1, keepdims = True)) / std
+
+    fig, axes = plt.subplots(3, 1, figsize = (12, 8), sharex = True,
+                             gridspec_kw = {'height_ratios': [1, 1, 4]})
+
+    axes[0].plot(summary['global'])
+    axes[0].set_ylabel('global')
+    axes[1].plot(summary['framewise'])
+    axes[1].set_ylabel('DVARS')
+    axes[2].imshow(ApplyWindow(carpet, (-2, 2), cmap = cmap), aspect = 'auto',
+                   interpolation = 'nearest')
+    axes[2].set_ylabel('voxels')
+    axes[2].set_xlabel('volume')
+    axes[2].set_yticks([])
+
+    plt.tight_layout()
     if outfile:
-        tmpdir = tempfile.TemporaryDirectory()
+        plt.savefig(outfile, bbox_inches = 'tight')
+    plt.show()
 
-    plt.figure()
 
-    for v in range(0,data.shape[-1]):
-        SliceView(data[..., v], plot_axis=plt.gca(), slice_number=sliceno,
-                  view_axis=view_axis, cmap = 'gray')
-        if outfile:
-            plt.savefig(os.path.join(tmpdir.name, 'temp_{:03d}.png'.format(v)), bbox_inches = 'tight')
+# animation helpers: frames are built directly as uint8 rgb arrays and
+# streamed to an encoder, no matplotlib rendering or temp files involved
+
+def LoopData(image, sliceno = None, view_axis = 2):
+    """
+    Gather the 2d slice for every frame of a movie
+
+    Parameters
+    ----------
+    image: path to nifti file, nibabel image, or numpy array / image proxy
+    sliceno: int, optional
+        slice to show, middle slice if not given
+    view_axis: int
+
+    Returns
+    -------
+    numpy array (x, y, frames). 4d data loops over volumes at a fixed
+    slice, 3d data loops over slices.
+    """
+    import nibabel as nib
+
+    if type(image) is str:
+        image = nib.load(image)
+    if isinstance(image, nib.spatialimages.SpatialImage):
+        image = image.dataobj
+
+    if len(image.shape) > 3:
+        if sliceno is None:
+            sliceno = int(image.shape[view_axis]/2)
+        # only read the one slice from every volume
+        slicer = [slice(None)] * len(image.shape)
+        slicer[view_axis] = sliceno
+        return np.asanyarray(image[tuple(slicer)])
+
+    return np.moveaxis(np.asanyarray(image), view_axis, -1)
+
+
+def MakeFrames(plotdata, cmap = 'gray', mag = 1, percentiles = (1, 99)):
+    """
+    Turn one or more (x, y, frames) arrays into rgb movie frames
+
+    Parameters
+    ----------
+    plotdata: numpy array or list of arrays
+        arrays are tiled left to right and must have the same number
+        of frames
+    cmap: str
+        matplotlib colormap name
+    mag: int
+        integer magnification (pixel replication)
+    percentiles: (low, high)
+        display range, computed once per array so all frames match
+
+    Returns
+    -------
+    uint8 numpy array (frames, height, width, 3)
+    """
+    if type(plotdata) is not list:
+        plotdata = [plotdata]
+
+    tiles = list()
+    for data in plotdata:
+        window = WindowLevels(data, percentiles)
+        # (x, y, t) -> (t, y, x) flipped vertically, same as np.rot90
+        data = np.asarray(data).transpose(2, 1, 0)[:, ::-1, :]
+        tiles.append(ApplyWindow(data, window, cmap = cmap))
+
+    height = max(t.shape[1] for t in tiles)
+    tiles = [np.pad(t, ((0, 0), (0, height - t.shape[1]), (0, 0), (0, 0)))
+             for t in tiles]
+    frames = np.concatenate(tiles, axis = 2)
+
+    mag = int(mag)
+    if mag > 1:
+        frames = frames.repeat(mag, axis = 1).repeat(mag, axis = 2)
+    return frames
+
+
+def WriteAnimation(frames, outfile, fps = 10):
+    """
+    Stream rgb frames to an animated gif/mp4 without temp files
+
+    Uses imageio if it can write the format (mp4 needs imageio-ffmpeg),
+    otherwise pipes raw frames to ffmpeg.
+
+    Parameters
+    ----------
+    frames: uint8 numpy array (frames, height, width, 3)
+    outfile: str
+        output filename, format is taken from the extension
+    fps: int
+    """
+    try:
+        import imageio.v2 as imageio
+    except ImportError:
+        imageio = None
+
+    writer = None
+    if imageio:
+        try:
+            if str(outfile).lower().endswith('.gif'):
+                writer = imageio.get_writer(outfile, mode = 'I',
+                                            duration = 1000 / fps, loop = 0)
+            else:
+                # asked for by name, or another plugin that can't take
+                # fps (e.g. pydicom) may claim the file
+                writer = imageio.get_writer(outfile, format = 'FFMPEG',
+                                            fps = fps)
+        except (ImportError, ValueError):
+            # imageio-ffmpeg isn't installed
+            writer = None
+
+    if writer:
+        with writer:
+            for frame in frames:
+                writer.append_data(frame)
+        return
+
+    # codecs want even dimensions
+    height, width = frames.shape[1:3]
+    frames = np.pad(frames, ((0, 0), (0, height % 2), (0, width % 2), (0, 0)))
+    command = ['ffmpeg', '-y', '-loglevel', 'error', '-f', 'rawvideo',
+               '-pix_fmt', 'rgb24', '-s', '{}x{}'.format(*frames.shape[2:0:-1]),
+               '-r', str(fps), '-i', '-']
+    if not str(outfile).lower().endswith('.gif'):
+        command += ['-pix_fmt', 'yuv420p']
+    process = subprocess.Popen(command + [str(outfile)], stdin = subprocess.PIPE)
+    try:
+        for frame in frames:
+            process.stdin.write(np.ascontiguousarray(frame).tobytes())
+        process.stdin.close()
+    except BrokenPipeError:
+        # ffmpeg quit, its exit code says why
+        pass
+    if process.wait():
+        raise RuntimeError('ffmpeg failed writing {} (exit code {})'.format(
+            outfile, process.returncode))
+
+
+def PlayFrames(frames, delay = 0.1):
+    """
+    Show precomputed rgb frames one after another in the notebook
+    """
+    import matplotlib.pyplot as plt
+    from IPython.display import clear_output
+
+    plt.figure()
+    for frame in frames:
+        plt.imshow(frame)
+        plt.axis('off')
         plt.show()
-        sleep(0.1)
+        sleep(delay)
         clear_output(wait=True)
 
+## EVERYTHING BELOW THIS NEEDS FIXING STILL
+
+# loop through like a movie
+def Loop(niftipath, sliceno = None, view_axis = 2, outfile = None, cmap = 'gray',
+         mag = 1, fps = 10, percentiles = (1, 99)):
+
+    frames = MakeFrames(LoopData(str(niftipath), sliceno = sliceno,
+                                 view_axis = view_axis), cmap = cmap, mag = mag,
+                        percentiles = percentiles)
+
     if outfile:
-        subprocess.call(['convert', os.path.join(tmpdir.name, '*.png'), outfile])
+        WriteAnimation(frames, outfile, fps = fps)
+    else:
+        PlayFrames(frames, delay = 1 / fps)
 
 
 
 def dtiView(fa_file, v1_file, plot_array = (1,1), view = 'axial', mag = 1, crop = 0, outfile = None):
+    import nibabel as nib
+
     v1 = nib.load(v1_file)
     fa = nib.load(fa_file)
     fa_v1 = np.clip(fa.get_data(), 0, 1)[..., None]*np.abs(v1.get_data())
@@ -187,59 +788,27 @@ def dtiView(fa_file, v1_file, plot_array = (1,1), view = 'axial', mag = 1, crop
 
 # loop through multiple volumes in parallel
 # Should be able to replace loop with this
-# can be slow, mag can be a problem?
-def NewLoop(volumes, cmap = 'gray', sliceno = None, view = 'a', outfile = None, mag = 1):   
+def NewLoop(volumes, cmap = 'gray', sliceno = None, view = 'a', outfile = None,
+            mag = 1, fps = 10, percentiles = (1, 99)):
 
     # if we weren't sent a list, make it a list
     if type(volumes) is not list:
         volumes = [volumes]
 
-    # prep data
-    plotdata = list()
-    for image in volumes:
-
-        if type(image) is str: #assume it's a nifti file
-            img = nib.load(image)
-            data = img.dataobj
-
-        else:
-            data = image # hope it's a numpy array or image proxy
-
-        axis = 2
-        if view.lower().startswith('c'):
-            axis = 1
-        elif view.lower().startswith('s'):
-            axis = 0
-
-        data = np.moveaxis(data, axis, -1) # send slice axis to the back
-
-        if len(data.shape) > 3:
-            if not sliceno:
-                sliceno = int(data.shape[-1]/2)
-            data = data[...,sliceno]
+    axis = 2
+    if view.lower().startswith('c'):
+        axis = 1
+    elif view.lower().startswith('s'):
+        axis = 0
 
-        plotdata.append(data)
-
-    nvols = plotdata[0].shape[-1] 
-
-    if outfile:
-        tmpdir = tempfile.TemporaryDirectory()
+    # prep data
+    plotdata = [LoopData(image, sliceno = sliceno, view_axis = axis)
+                for image in volumes]
 
-    dpi = 72
-    stampsize = np.array(plotdata[0].shape)*mag/dpi
-    plt.figure(figsize=(stampsize[0]* nvols, 1), dpi = dpi)
-
-    for v in range(0, nvols):
-        for i, d in enumerate(plotdata):
-            plt.subplot(1, len(plotdata), i+1)
-            plt.axis('off')
-            plt.imshow(np.rot90(d[...,v]), cmap=cmap)
-        plt.gcf().tight_layout()
-        if outfile:
-            plt.savefig(os.path.join(tmpdir.name, 'temp_{:03d}.png'.format(v)), bbox_inches = 'tight')
-        plt.show()
-        sleep(0.1)
-        clear_output(wait=True)
+    frames = MakeFrames(plotdata, cmap = cmap, mag = mag,
+                        percentiles = percentiles)
 
     if outfile:
-        subprocess.call(['convert', os.path.join(tmpdir.name, '*.png'), outfile])
\ No newline at end of file
+        WriteAnimation(frames, outfile, fps = fps)
+    else:
+        PlayFrames(frames, delay = 1 / fps)
\ No newline at end of file
@@ -5,6 +5,8 @@ talapas high performance computing cluser at the University of Oregon.
 """
 
 import subprocess
+import hashlib
+import io
 import os
 import glob
 import time
@@ -41,7 +43,7 @@ def SlurmThrottle():
     """
     subprocess.run(['/packages/racs/bin/slurm-throttle'])
 
-def SubmitSlurmFile(filename):
+def SubmitSlurmFile(filename, options = None):
     """ submit a file to slurm using sbatch
 
     Submits a file to slurm using sbatch, and prints the stdout from 
@@ -50,6 +52,9 @@ def SubmitSlurmFile(filename):
     Parameters
     ----------
     filename: path to file
+    options: list[str], optional
+        extra sbatch options, e.g. ['--array=3,17', '--time=2:00:00'].
+        These override the #SBATCH lines in the file.
 
     Returns
     -------
@@ -60,14 +65,14 @@ def SubmitSlurmFile(filename):
     if not os.path.exists(filename):
         print('{} not found'.format(filename))
         return None
-    process = subprocess.run(['sbatch', filename], 
+    process = subprocess.run(['sbatch'] + (options if options else []) + [filename], 
                              stdout=subprocess.PIPE, 
                              stderr=subprocess.STDOUT, 
                              universal_newlines=True)
 
     print(process.stdout)
 
-    if process.stdout.split()[0] == 'Submitted':
+    if process.stdout.split() and process.stdout.split()[0] == 'Submitted':
         jobid = process.stdout.split()[-1]
     else :
         jobid = None
@@ -75,33 +80,126 @@ def SubmitSlurmFile(filename):
     return jobid
 
 
-def WaitUntilComplete(jobid):
+state_classes = {'COMPLETED': 'completed', 
+                 'NODE_FAIL': 'transient', 'PREEMPTED': 'transient', 
+                 'BOOT_FAIL': 'transient',
+                 'TIMEOUT': 'timeout', 'DEADLINE': 'timeout',
+                 'OUT_OF_MEMORY': 'memory',
+                 'FAILED': 'failed', 'CANCELLED': 'failed', 
+                 'REVOKED': 'failed',
+                 'PENDING': 'active', 'RUNNING': 'active', 
+                 'REQUEUED': 'active', 'RESIZING': 'active', 
+                 'SUSPENDED': 'active', 'CONFIGURING': 'active', 
+                 'COMPLETING': 'active', 'STAGE_OUT': 'active'}
+"""sacct job states by how they matter for a retry: 'transient' (the 
+node's fault, retry as is), 'timeout' and 'memory' (retry with more),
+'failed' (the job's fault), 'active' (not finished)
+"""
+
+def ClassifyState(state):
+    """class of a sacct state, see state_classes. 'failed' if unknown.
+    """
+    # e.g. 'CANCELLED by 1234'
+    return state_classes.get(state.split()[0] if state.split() else state, 'failed')
+
+def TaskStates(jobid):
+    """state of a job, or each task of an array job
+
+    Parameters
+    ----------
+    jobid
+        id of job
+
+    Returns
+    -------
+    dict of array index (None for a job that isn't an array) -> state
+    Pending array tasks not started yet are under their range, e.g. '[4-9]'
+    """
+    process = subprocess.run(['sacct', '-X', '-n', '-P', '-j', str(jobid), 
+                              '--format', 'jobid,state'],
+                             stdout=subprocess.PIPE, stderr=subprocess.STDOUT,
+                             universal_newlines=True)
+    states = dict()
+    for line in process.stdout.split('\n'):
+        if '|' not in line:
+            continue
+        task, state = line.split('|')[:2]
+        if '_' in task:
+            index = task.split('_', 1)[1]
+            states[int(index) if index.isdigit() else index] = state
+        else:
+            states[None] = state
+    return states
+
+
+def WaitUntilComplete(jobid, poll = 10):
     """wait until job completes.
 
     Parameters
     ----------
     jobid: slurm job id of job to monitor
+    poll: seconds between checks
+
+    Returns
+    -------
+    True if the job (every task of an array) COMPLETED, otherwise
+    prints the states and returns False
     """
 
-    time.sleep(10)
+    time.sleep(poll)
+    warned = False
     while True:
-        if not AnyJobs(jobid, 'PENDING') and not AnyJobs(jobid, 'RUNNING'):
-            if AllJobs(jobid,'COMPLETED'):
+        states = TaskStates(jobid)
+        if states and 'active' not in [ClassifyState(s) for s in states.values()]:
+            if all(s == 'COMPLETED' for s in states.values()):
                 print('Job complete')
-                return
+                return True
             else:
                 print(JobStatus(jobid))
-                assert False
+                return False
 
-        if AnyJobs(jobid, 'PENDING'):
+        # slurm will start it when the nodes are back, just say so once
+        if not warned and 'PENDING' in states.values():
             queue = subprocess.run('squeue', stdout=subprocess.PIPE, 
                              stderr=subprocess.STDOUT, universal_newlines=True).stdout
             for line in queue.split('\n'):
-                if jobid in line and 'ReqNodeNotAvail' in line:
+                if str(jobid) in line and 'ReqNodeNotAvail' in line:
                     print(line)
-                    assert False
+                    warned = True
+
+        time.sleep(poll)
+
+
+def ParseTime(slurm_time):
+    """slurm time limit (minutes, MM:SS, HH:MM:SS, D-HH, D-HH:MM or 
+    D-HH:MM:SS) in seconds
+    """
+    slurm_time = str(slurm_time)
+    days = 0
+    if '-' in slurm_time:
+        days, slurm_time = slurm_time.split('-')
+        fields = [int(x) for x in slurm_time.split(':')]
+        fields += [0] * (3 - len(fields))
+    else:
+        fields = [int(x) for x in slurm_time.split(':')]
+        fields = {1: [0, fields[0], 0], 2: [0] + fields, 3: fields}[len(fields)]
+    return int(days) * 86400 + fields[0] * 3600 + fields[1] * 60 + fields[2]
+
+def FormatTime(seconds):
+    """seconds as a slurm D-HH:MM:SS time limit
+    """
+    seconds = int(seconds)
+    return '{}-{:02d}:{:02d}:{:02d}'.format(seconds // 86400, 
+        seconds % 86400 // 3600, seconds % 3600 // 60, seconds % 60)
+
+def ParseMemory(mem):
+    """slurm memory size (e.g. 4G, 500M, 4000) in megabytes
+    """
+    match = re.match('^([0-9.]+)([KMGT]?)B?$', str(mem).strip().upper())
+    if not match:
+        raise ValueError('Unable to parse memory size {}'.format(mem))
+    return float(match.group(1)) * 1024 ** ('KMGT'.index(match.group(2) or 'M') - 1)
 
-        time.sleep(10)
 
 def WrapSlurmCommand(command, jobname = None, index = None, 
                      output_directory = None, dependency = None, 
@@ -204,12 +302,13 @@ def WrapSlurmCommand(command, jobname = None, index = None,
         return None
 
 
-def WriteSlurmFile(jobname, command, filename = None, 
+def WriteSlurmFile(jobname, command = None, filename = None, 
                    interpreter = 'bash', index = None,  
                    array = None, variable = 'x', 
                    output_directory = None, dependency = None,
                    threads = None, array_limit = None, deptype = 'ok', 
-                   email = None, **slurm_params):
+                   email = None, tasks = None, steps = 'srun', 
+                   parallel = None, **slurm_params):
     
     """Write a script to be submitted to slurm using sbatch
 
@@ -240,12 +339,29 @@ def WriteSlurmFile(jobname, command, filename = None,
     index: str, optional
         UO index for charges, will be written to comment field
     array: list, optional
-        array to use for job array
+        array to use for job array. Items are written one per line to
+        {filename}.<hash>.items (see WriteArrayManifest), and each task reads
+        its own into variable, so items may contain spaces but not 
+        newlines
     variable: string, default = 'x'
         variable to use for array substitution in command
     array-limit: int
         maximum number of concurrently running tasks
         NOT CURRENTLY IMPLEMENTED
+    tasks: list[str], optional
+        independent commands to run as steps of this one job, after
+        command (e.g. module loads). Exit codes are written to 
+        {jobname}-{jobid}.steps in output_directory (or the submit 
+        directory), one "index exit_code" line per step
+    steps: str, default = 'srun'
+        'srun' runs each task as an srun --exclusive -n1 step, 
+        parallel (default $SLURM_NTASKS) at a time, and sets --ntasks
+        to parallel if ntasks isn't given (steps see only exported
+        variables from command). 'background' runs them as 
+        background processes, parallel (default $SLURM_CPUS_ON_NODE) 
+        at a time, for single node jobs
+    parallel: int, optional
+        most steps running at once
     **slurm_params
         additional slurm parameters
 
@@ -289,60 +405,248 @@ def WriteSlurmFile(jobname, command, filename = None,
     if not filename:
         filename = jobname + '.srun'
 
-    with open (filename, 'w') as f:
-        if interpreter == 'python':
-            f.write('#!{}\n'.format(sys.executable))
-
-        elif interpreter == 'bash':
-            f.write('#!/bin/bash\n')
-            
-        else : # caller sent full path to interpreter
-            f.write('#!{}\n'.format(interpreter))
-
-        f.write('#SBATCH --job-name={}\n'.format(jobname))
+    if tasks is not None:
+        if array:
+            raise ValueError('tasks and array are exclusive')
+        if interpreter != 'bash':
+            raise ValueError('tasks need a bash script')
+        if steps not in ('srun', 'background'):
+            raise ValueError('steps should be srun or background')
+        if steps == 'srun' and parallel and 'ntasks' not in slurm_params:
+            slurm_params['ntasks'] = parallel
+
+    f = io.StringIO()
+    if interpreter == 'python':
+        f.write('#!{}\n'.format(sys.executable))
+
+    elif interpreter == 'bash':
+        f.write('#!/bin/bash\n')
+        
+    else : # caller sent full path to interpreter
+        f.write('#!{}\n'.format(interpreter))
 
-        if email:
-            f.write('#SBATCH --mail-user={}\n'.format(email))
-            f.write('#SBATCH --mail-type=END\n')
+    f.write('#SBATCH --job-name={}\n'.format(jobname))
 
-        if dependency:
-             f.write('#SBATCH --dependency=after{}:{}\n'.format(deptype, dependency))
+    if email:
+        f.write('#SBATCH --mail-user={}\n'.format(email))
+        f.write('#SBATCH --mail-type=END\n')
 
-        if threads:
-            f.write('#SBATCH --cpus-per-task={}\n'.format(threads))
+    if dependency:
+         f.write('#SBATCH --dependency=after{}:{}\n'.format(deptype, dependency))
 
-        if index:
-            f.write('#SBATCH --comment=idx:{}\n'.format(index))
+    if threads:
+        f.write('#SBATCH --cpus-per-task={}\n'.format(threads))
 
-        for arg in slurm_params:
-            f.write('#SBATCH --{}={}\n'.format(arg, slurm_params[arg]))
+    if index:
+        f.write('#SBATCH --comment=idx:{}\n'.format(index))
 
-        if output_directory:
-            if not os.path.exists(output_directory):
-                os.mkdir(output_directory)
-            if array:
-                f.write('#SBATCH --output={}/%x-%A_%a.out\n'.format(output_directory))
-                f.write('#SBATCH --error={}/%x-%A_%a.err\n\n'.format(output_directory))           
-            else:
-                f.write('#SBATCH --output={}/%x-%j.out\n'.format(output_directory))
-                f.write('#SBATCH --error={}/%x-%j.err\n\n'.format(output_directory))
+    for arg in slurm_params:
+        f.write('#SBATCH --{}={}\n'.format(arg, slurm_params[arg]))
 
+    if output_directory:
+        if not os.path.exists(output_directory):
+            os.mkdir(output_directory)
         if array:
-            f.write('#SBATCH --array=0-{}'.format(len(array) - 1))
-            if array_limit:
-                f.write('%{}'.format(array_limit))
-            f.write('\n\ndata=({})\n\n'.format(' '.join(array)))
-            f.write('{}=${{data[$SLURM_ARRAY_TASK_ID]}}\n\n'.format(variable))
-            #if variable not in command:
-            #   print('Warning: {} not found in {}. Are you sure about this?'.format(variable, command))
+            f.write('#SBATCH --output={}/%x-%A_%a.out\n'.format(output_directory))
+            f.write('#SBATCH --error={}/%x-%A_%a.err\n\n'.format(output_directory))           
+        else:
+            f.write('#SBATCH --output={}/%x-%j.out\n'.format(output_directory))
+            f.write('#SBATCH --error={}/%x-%j.err\n\n'.format(output_directory))
+
+    if array:
+        f.write('#SBATCH --array=0-{}'.format(len(array) - 1))
+        if array_limit:
+            f.write('%{}'.format(array_limit))
+        f.write('\n\n')
+        items = WriteArrayManifest(array, filename)
+        if interpreter == 'python':
+            f.write(python_lookup.format(items = items, variable = variable,
+                                         width = index_width))
+        else:
+            f.write(bash_lookup.format(items = items, variable = variable,
+                                       width = index_width))
 
 
-        if type(command) is str:
-            command = [command]
+    if type(command) is str:
+        command = [command]
+    if command:
         f.write('\n')
         f.write('\n'.join(command))
 
+    if tasks is not None:
+        f.write('\n' + StepBlock(jobname, tasks, steps, parallel, 
+                                 output_directory))
+
+    # the script names its manifest by content, not the items themselves,
+    # so resubmitting the same job reuses it as is
+    script = f.getvalue()
+    if os.path.exists(filename):
+        with open(filename) as f:
+            if f.read() == script:
+                return filename
+    with open(filename, 'w') as f:
+        f.write(script)
+
+    return filename
+
+
+index_width = 16
+"""digits in each record of an array manifest's offset index
+"""
+
+bash_lookup = """items="{items}"
+offset=$(tail -c +$((SLURM_ARRAY_TASK_ID * ({width} + 1) + 1)) "$items.idx" | head -c {width})
+{variable}=$(tail -c +$((10#$offset + 1)) "$items" | head -n 1)
+
+"""
+
+python_lookup = """import os
+with open("{items}.idx", "rb") as _f:
+    _f.seek(int(os.environ["SLURM_ARRAY_TASK_ID"]) * ({width} + 1))
+    _offset = int(_f.read({width}))
+with open("{items}", "rb") as _f:
+    _f.seek(_offset)
+    {variable} = _f.readline().decode().rstrip("\\n")
+
+"""
+
+
+def WriteArrayManifest(array, prefix):
+    """Write job array items to a manifest for the tasks to look up
+
+    Items go one per line in the manifest, and manifest.idx holds the 
+    byte offset of each line as a fixed width record, so a task finds its
+    item with two seeks however long the array is. The manifest is named
+    after a hash of its content, prefix.<hash>.items: tasks read it when
+    they run, so a new array must not replace the one pending tasks of an
+    earlier submission will read, while the same array keeps its name
+    (and the script its text).
+
+    Parameters
+    ----------
+    array: list
+        array items, str() of each is written
+    prefix: str
+        manifest name up to the hash
+
+    Returns
+    -------
+    absolute path of the manifest
+
+    Raises
+    ------
+    ValueError if an item contains a newline
+    """
+    prefix = os.path.abspath(prefix)
+    temp = '{}.{}.tmp'.format(prefix, os.getpid())
+    h = hashlib.blake2b(digest_size = 8)
+    offset = 0
+    try:
+        with open(temp, 'wb') as items, open(temp + '.idx', 'wb') as index:
+            for item in array:
+                item = str(item)
+                if '\n' in item:
+                    raise ValueError('array item {!r} contains a newline'.format(item))
+                line = (item + '\n').encode()
+                index.write('{:0{}d}\n'.format(offset, index_width).encode())
+                items.write(line)
+                h.update(line)
+                offset += len(line)
+        filename = '{}.{}.items'.format(prefix, h.hexdigest())
+        # index first, the manifest existing means both are complete
+        os.replace(temp + '.idx', filename + '.idx')
+        os.replace(temp, filename)
+    finally:
+        for leftover in [temp, temp + '.idx']:
+            if os.path.exists(leftover):
+                os.remove(leftover)
     return filename
+
+
+def ReadArrayItem(filename, task_id):
+    """Look up one item of an array manifest
+
+    Parameters
+    ----------
+    filename: str
+        manifest written by WriteArrayManifest
+    task_id: int
+        array index
+
+    Returns
+    -------
+    the item, as a str
+    """
+    with open(filename + '.idx', 'rb') as f:
+        f.seek(task_id * (index_width + 1))
+        offset = int(f.read(index_width))
+    with open(filename, 'rb') as f:
+        f.seek(offset)
+        return f.readline().decode().rstrip('\n')
+
+
+# shell to run tasks as steps of one job, at most parallel at a time,
+# recording each step's exit code
+def StepBlock(jobname, tasks, steps = 'srun', parallel = None, 
+              output_directory = None):
+    if steps == 'srun':
+        launch = ('srun --exclusive -N1 -n1 -c "${SLURM_CPUS_PER_TASK:-1}" '
+                  'bash -c "$(declare -f task_$1); task_$1"')
+        default = '${SLURM_NTASKS:-1}'
+    else:
+        launch = '( task_$1 )'
+        default = '${SLURM_CPUS_ON_NODE:-1}'
+
+    steps_dir = output_directory or '${SLURM_SUBMIT_DIR:-.}'
+    lines = ['',
+             'steps_file="{}/{}-${{SLURM_JOB_ID}}.steps"'.format(steps_dir, 
+                                                               jobname),
+             ': > "$steps_file"',
+             'max_steps={}'.format(parallel or default),
+             '']
+    for i, task in enumerate(tasks):
+        if type(task) is not str:
+            task = '\n'.join(task)
+        lines += ['task_{}() {{'.format(i), task, '}', '']
+    lines += ['run_step() {',
+              '    {}'.format(launch),
+              '    echo "$1 $?" >> "$steps_file"',
+              '}',
+              '',
+              'for i in $(seq 0 {}); do'.format(len(tasks) - 1),
+              '    while [ "$(jobs -rp | wc -l)" -ge "$max_steps" ]; do',
+              '        wait -n',
+              '    done',
+              '    run_step $i &',
+              'done',
+              'wait',
+              '',
+              'failed=$(awk \'$2 != 0\' "$steps_file" | wc -l)',
+              'echo "{} steps, $failed failed"'.format(len(tasks)),
+              '[ "$failed" -eq 0 ]',
+              '']
+    return '\n'.join(lines)
+
+
+def ReadStepResults(filename):
+    """Read the exit codes of a job's steps
+
+    Parameters
+    ----------
+    filename: str
+        .steps file written by a job with tasks
+
+    Returns
+    -------
+    dict of task index to exit code
+    """
+    results = {}
+    with open(filename) as f:
+        for line in f:
+            fields = line.split()
+            if len(fields) == 2:
+                results[int(fields[0])] = int(fields[1])
+    return results
         
 
 def Notify(jobid, email, **kwargs):
@@ -476,6 +780,12 @@ class SlurmJob:
     array-limit: int
         maximum number of concurrently running tasks
         NOT CURRENTLY IMPLEMENTED
+    tasks: list[str]
+        independent commands to run as steps within one allocation
+    steps: str, default = 'srun'
+        run tasks as 'srun' steps or 'background' processes
+    parallel: int
+        most tasks running at once
     Any other parameters will be treated as SBATCH arguments
 
     Examples
@@ -491,6 +801,13 @@ class SlurmJob:
     sj.WriteSlurmFile('example2.srun')
     sj.SubmitSlurmFile()
 
+    sj = SlurmJob(jobname = 'steps', account = 'pirg', parallel = 4)
+    sj.command = 'module load fsl'
+    sj.tasks = ['fslinfo file{}'.format(i) for i in range(20)]
+    sj.WriteSlurmFile()
+    sj.SubmitSlurmFile()
+    WaitUntilComplete(sj._jobid)
+    sj.StepResults()
 
     """
     def __init__(self, **kwargs):
@@ -498,7 +815,7 @@ class SlurmJob:
         for key in kwargs:
             setattr(self, key, kwargs[key])
 
-    def WriteSlurmFile(self, filename = None, interpreter = 'bash'):
+    def WriteSlurmFile(self, filename = None, interpreter = None):
 
         """Write a script to be submitted to slurm using sbatch
 
@@ -507,8 +824,8 @@ class SlurmJob:
         filename: str, optional
             name for script file, will be jobname.srun if not given
         interpreter: str, optional
-            path to interpreter
-            if 'bash' (default), will use /bin/bash
+            path to interpreter, default the job's interpreter or 
+            'bash', which will use /bin/bash
 
         Returns
         -------
@@ -528,21 +845,112 @@ class SlurmJob:
             self.filename = '{}.srun'.format(self.jobname)
 
         params = {k:vars(self)[k] for k in vars(self) if not k.startswith('_')}
+        params['interpreter'] = interpreter or getattr(self, 'interpreter', 'bash')
         slurmfile = WriteSlurmFile(**params)
 
         return slurmfile
 
-    def SubmitSlurmFile(self):
+    def SubmitSlurmFile(self, options = None):
         """Submit script to job manager
 
+        Parameters
+        ----------
+        options: list[str], optional
+            extra sbatch options, see SubmitSlurmFile
+
         Returns
         -------
         jobid of spawned job
 
         """
-        self._jobid = SubmitSlurmFile(self.filename)         
+        self._jobid = SubmitSlurmFile(self.filename, options)         
         return self._jobid
 
+    def RunWithRetry(self, max_attempts = 3, retry = ['transient', 'timeout', 'memory'],
+                     bump_time = 2, bump_mem = 1.5, backoff = 60, poll = 30):
+        """Submit the job, wait for it, and resubmit what failed
+
+        Each failed job, or each failed task of an array job, is put in a
+        class (see state_classes). Tasks whose class is in retry are 
+        resubmitted (for arrays only those indices, with --array) until 
+        they have run max_attempts times. Tasks that timed out get 
+        bump_time times the time limit, tasks that ran out of memory 
+        bump_mem times the memory (only if time or mem was set). 
+        Transient failures wait backoff seconds, doubled each attempt,
+        before they're resubmitted.
+
+        Parameters
+        ----------
+        max_attempts: int, default = 3
+            most times any task is run
+        retry: list[str], default = ['transient', 'timeout', 'memory']
+            classes of failure to retry, 'failed' can be added
+        bump_time: float or None, default = 2
+        bump_mem: float or None, default = 1.5
+        backoff: seconds, default = 60
+        poll: seconds between status checks, default = 30
+
+        Returns
+        -------
+        dict of array index (None if not an array) -> final state
+
+        Examples
+        --------
+        sj = SlurmJob(jobname = 'convert', time = '1:00:00', mem = '4G')
+        sj.command = 'bash ${x}'
+        sj.array = scripts
+        sj.WriteSlurmFile()
+        failed = {i: s for i, s in sj.RunWithRetry().items() 
+                  if s != 'COMPLETED'}
+        """
+        if not hasattr(self, 'filename'):
+            self.WriteSlurmFile()
+
+        # (jobid, resources it was submitted with)
+        resources = {'time': getattr(self, 'time', None), 
+                     'mem': getattr(self, 'mem', None)}
+        submissions = [(self.SubmitSlurmFile(), resources)]
+        self._jobids = [submissions[0][0]]
+        final = dict()
+        attempts = dict()
+
+        while submissions:
+            jobid, resources = submissions.pop(0)
+            if not jobid:
+                continue
+            WaitUntilComplete(jobid, poll)
+
+            # failed tasks by class
+            failed = dict()
+            for index, state in TaskStates(jobid).items():
+                final[index] = state
+                attempts[index] = attempts.get(index, 0) + 1
+                kind = ClassifyState(state)
+                if kind in retry and attempts[index] < max_attempts:
+                    failed.setdefault(kind, []).append(index)
+
+            for kind, indices in failed.items():
+                bumped = dict(resources)
+                if kind == 'timeout' and bump_time and bumped['time']:
+                    bumped['time'] = FormatTime(ParseTime(bumped['time']) * bump_time)
+                if kind == 'memory' and bump_mem and bumped['mem']:
+                    bumped['mem'] = '{}M'.format(int(ParseMemory(bumped['mem']) * bump_mem))
+                if kind == 'transient' and backoff:
+                    time.sleep(backoff * 2 ** (max(attempts[i] for i in indices) - 1))
+
+                options = ['--{}={}'.format(k, v) for k, v in bumped.items() if v]
+                if indices != [None]:
+                    array = ','.join(str(i) for i in sorted(indices))
+                    if getattr(self, 'array_limit', None):
+                        array += '%{}'.format(self.array_limit)
+                    options.append('--array={}'.format(array))
+                print('Resubmitting {} {} task(s), attempt {}'.format(len(indices), kind, 
+                    max(attempts[i] for i in indices) + 1))
+                submissions.append((self.SubmitSlurmFile(options), bumped))
+                self._jobids.append(self._jobid)
+
+        return final
+
 
 
     def WrapSlurmCommand(self):
@@ -591,6 +999,25 @@ class SlurmJob:
             return sorted(glob.glob(filename + '*.' + extension))
 
 
+    def StepResults(self):
+        """Get the exit codes of a job's tasks
+
+        Returns
+        -------
+        dict of task index to exit code, empty if the job hasn't 
+        written any
+        """
+        if not hasattr(self, '_jobid'):
+            return dict()
+
+        stepfile = '{}-{}.steps'.format(self.jobname, self._jobid)
+        if hasattr(self, 'output_directory') and self.output_directory :
+            stepfile = os.path.join(self.output_directory, stepfile)
+        if not os.path.exists(stepfile):
+            return dict()
+        return ReadStepResults(stepfile)
+
+
     def Notify(self, email = None):
         """ send a notification when job finishes
 